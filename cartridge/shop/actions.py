@@ -0,0 +1,191 @@
+"""
+Write-behind buffering of ``ProductAction`` counters. When the
+``SHOP_PRODUCT_ACTION_BUFFER`` setting is enabled, increments are
+accumulated in process memory or in the Django cache, and periodically
+written to the database as bulk ``F()`` expression upserts, rather
+than each add-to-cart and purchase contending on the same row.
+"""
+from __future__ import unicode_literals
+from future.builtins import range
+
+import atexit
+from collections import defaultdict
+from threading import Lock, Timer
+from time import time
+
+from django.core.cache import cache
+from django.db import connection
+from mezzanine.conf import settings
+
+
+CACHE_KEY_PREFIX = "cartridge-product-actions"
+CACHE_COUNT_KEY = CACHE_KEY_PREFIX + "-count"
+CACHE_FLUSHED_KEY = CACHE_KEY_PREFIX + "-flushed"
+CACHE_FLUSH_DUE_KEY = CACHE_KEY_PREFIX + "-due"
+CACHE_GAP_KEY = CACHE_KEY_PREFIX + "-gap"
+CACHE_LOCK_KEY = CACHE_KEY_PREFIX + "-lock"
+CACHE_SLOT_KEY = CACHE_KEY_PREFIX + "-slot-%s"
+
+# Seconds a slot can be missing from the cache before a flush treats
+# it as evicted, rather than allocated but not yet set.
+CACHE_SLOT_TIMEOUT = 60
+
+_lock = Lock()
+_buffer = defaultdict(int)
+# Time of the first increment buffered since the last flush, and the
+# timer that flushes the buffer if no further increments do.
+_state = {"pending": 0, "first_buffered": None, "timer": None}
+
+
+def write(counts):
+    """
+    Given a dict mapping ``(field, timestamp, product_id)`` keys to
+    amounts, writes them to ``ProductAction`` with a single bulk
+    upsert for each field and day.
+    """
+    from cartridge.shop.models import ProductAction
+    grouped = defaultdict(lambda: defaultdict(int))
+    for (field, timestamp, product_id), amount in counts.items():
+        grouped[(field, timestamp)][product_id] += amount
+    for (field, timestamp), amounts in grouped.items():
+        ProductAction.objects.increment(field, amounts, timestamp)
+
+
+def buffer(field, amounts, timestamp):
+    """
+    Buffers the given dict of product IDs and amounts to increase the
+    given field by for the given ordinal day, flushing the buffer if
+    ``SHOP_PRODUCT_ACTION_FLUSH_INTERVAL`` seconds have passed since
+    the first increment it holds was buffered, or it holds
+    ``SHOP_PRODUCT_ACTION_BUFFER_MAX`` increments. Buffers in process
+    memory are also flushed by a timer once the interval has passed,
+    so that an idle process doesn't hold increments indefinitely.
+    """
+    if settings.SHOP_PRODUCT_ACTION_BUFFER == "cache":
+        _buffer_cache(field, amounts, timestamp)
+    else:
+        _buffer_memory(field, amounts, timestamp)
+
+
+def flush():
+    """
+    Writes any buffered increments to the database.
+    """
+    if settings.SHOP_PRODUCT_ACTION_BUFFER == "cache":
+        _flush_cache()
+    _flush_memory()
+
+
+def _buffer_memory(field, amounts, timestamp):
+    with _lock:
+        if _state["first_buffered"] is None:
+            _state["first_buffered"] = time()
+            _start_timer()
+        for product_id, amount in amounts.items():
+            _buffer[(field, timestamp, product_id)] += amount
+            _state["pending"] += amount
+        elapsed = time() - _state["first_buffered"]
+        due = (elapsed >= settings.SHOP_PRODUCT_ACTION_FLUSH_INTERVAL or
+               _state["pending"] >= settings.SHOP_PRODUCT_ACTION_BUFFER_MAX)
+    if due:
+        _flush_memory()
+
+
+def _flush_memory():
+    with _lock:
+        counts = dict(_buffer)
+        first_buffered = _state["first_buffered"]
+        _buffer.clear()
+        _state["pending"] = 0
+        _state["first_buffered"] = None
+        if _state["timer"] is not None:
+            _state["timer"].cancel()
+            _state["timer"] = None
+    if counts:
+        try:
+            write(counts)
+        except:
+            # Put the increments back so the next flush can retry.
+            with _lock:
+                for key, amount in counts.items():
+                    _buffer[key] += amount
+                    _state["pending"] += amount
+                if first_buffered is not None:
+                    _state["first_buffered"] = min(
+                        first_buffered, _state["first_buffered"] or time())
+                if _state["timer"] is None:
+                    _start_timer()
+            raise
+
+
+def _start_timer():
+    timer = Timer(settings.SHOP_PRODUCT_ACTION_FLUSH_INTERVAL, _flush_timer)
+    timer.daemon = True
+    timer.start()
+    _state["timer"] = timer
+
+
+def _flush_timer():
+    # Runs in the timer's own thread, which has its own database
+    # connection to close once the buffer is written.
+    try:
+        _flush_memory()
+    finally:
+        connection.close()
+
+
+def _buffer_cache(field, amounts, timestamp):
+    # Each buffered call gets its own slot, allocated with an atomic
+    # increment, so concurrent processes never overwrite each other.
+    cache.add(CACHE_COUNT_KEY, 0, None)
+    slot = cache.incr(CACHE_COUNT_KEY)
+    cache.set(CACHE_SLOT_KEY % slot, (field, timestamp, amounts), None)
+    pending = slot - cache.get(CACHE_FLUSHED_KEY, 0)
+    if (cache.get(CACHE_FLUSH_DUE_KEY) is None or
+            pending >= settings.SHOP_PRODUCT_ACTION_BUFFER_MAX):
+        _flush_cache()
+
+
+def _flush_cache():
+    if not cache.add(CACHE_LOCK_KEY, True, 60):
+        # Another process is already flushing.
+        return
+    try:
+        interval = settings.SHOP_PRODUCT_ACTION_FLUSH_INTERVAL
+        cache.set(CACHE_FLUSH_DUE_KEY, True, interval)
+        flushed = cache.get(CACHE_FLUSHED_KEY, 0)
+        count = cache.get(CACHE_COUNT_KEY, 0)
+        slots = cache.get_many([CACHE_SLOT_KEY % i
+                                for i in range(flushed + 1, count + 1)])
+        gap = cache.get(CACHE_GAP_KEY)
+        counts = defaultdict(int)
+        keys = []
+        # Only the slots up to the first missing one are read, since a
+        # missing slot may have been allocated by another process but
+        # not yet set. It's left for the next flush, which only skips
+        # it once it's been missing for CACHE_SLOT_TIMEOUT seconds, at
+        # which point it's assumed to have been evicted.
+        for slot in range(flushed + 1, count + 1):
+            key = CACHE_SLOT_KEY % slot
+            if key not in slots:
+                if gap is None or gap[0] != slot:
+                    gap = (slot, time())
+                    break
+                if time() - gap[1] < CACHE_SLOT_TIMEOUT:
+                    break
+            else:
+                field, timestamp, amounts = slots[key]
+                for product_id, amount in amounts.items():
+                    counts[(field, timestamp, product_id)] += amount
+            keys.append(key)
+            flushed = slot
+        if counts:
+            write(counts)
+        cache.set(CACHE_FLUSHED_KEY, flushed, None)
+        cache.set(CACHE_GAP_KEY, gap, None)
+        cache.delete_many(keys)
+    finally:
+        cache.delete(CACHE_LOCK_KEY)
+
+
+atexit.register(_flush_memory)
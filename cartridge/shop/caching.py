@@ -0,0 +1,132 @@
+"""
+Versioned caching of the computed context for product pages. Each
+cache key includes a global version, bumped when sales or categories
+change, and a version for the product, bumped when the product or any
+of its variations or images change, so that stale entries are never
+read and simply expire. The SKUs that discounts apply to are cached
+in the same way, with a version bumped when discounts, products or
+categories change.
+"""
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from mezzanine.conf import settings
+
+
+GLOBAL_VERSION_KEY = "cartridge-product-version"
+PRODUCT_VERSION_KEY = "cartridge-product-version-%s"
+PRODUCT_CONTEXT_KEY = "cartridge-product-context-%s-%s"
+PRODUCT_VALUE_KEY = "cartridge-product-%s-%s-%s"
+DISCOUNT_VERSION_KEY = "cartridge-discount-version"
+DISCOUNT_SKUS_KEY = "cartridge-discount-skus-%s-%s-%s"
+
+
+def bump_version(key):
+    """
+    Increments the given version key, invalidating any cache keys
+    built from it.
+    """
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Evicted between the add and the incr.
+            cache.add(key, 1, None)
+
+
+def invalidate_products(*product_ids):
+    """
+    Invalidates the cached context for the given product IDs, or for
+    all products if none are given.
+    """
+    if not product_ids:
+        bump_version(GLOBAL_VERSION_KEY)
+    for product_id in product_ids:
+        bump_version(PRODUCT_VERSION_KEY % product_id)
+
+
+def product_versions(product_ids):
+    """
+    Returns a dict mapping each of the given product IDs to a string
+    combining the global and product versions, for building cache
+    keys with.
+    """
+    keys = dict([(product_id, PRODUCT_VERSION_KEY % product_id)
+                 for product_id in product_ids])
+    versions = cache.get_many([GLOBAL_VERSION_KEY] + list(keys.values()))
+    global_version = versions.get(GLOBAL_VERSION_KEY, 0)
+    return dict([(product_id, "%s-%s" % (global_version,
+                                         versions.get(key, 0)))
+                 for product_id, key in keys.items()])
+
+
+def product_values(name, product_ids, load):
+    """
+    Returns a dict mapping each of the given product IDs to its
+    cached value for the given name, calling ``load`` with a list of
+    the IDs not cached to get a dict of their values. Values are only
+    cached when ``SHOP_PRODUCT_CACHE_SECONDS`` isn't zero.
+    """
+    timeout = settings.SHOP_PRODUCT_CACHE_SECONDS
+    if not timeout:
+        return load(list(product_ids))
+    versions = product_versions(product_ids)
+    keys = dict([(product_id, PRODUCT_VALUE_KEY % (name, product_id,
+                                                   version))
+                 for product_id, version in versions.items()])
+    cached = cache.get_many(list(keys.values()))
+    values = dict([(product_id, cached[key])
+                   for product_id, key in keys.items() if key in cached])
+    missing = [product_id for product_id in keys if product_id not in values]
+    if missing:
+        loaded = load(missing)
+        cache.set_many(dict([(keys[product_id], value)
+                             for product_id, value in loaded.items()]),
+                       timeout)
+        values.update(loaded)
+    return values
+
+
+def product_context(product, build):
+    """
+    Returns the cached context dict for the given product, calling
+    ``build`` with the product to create it if it isn't cached or
+    ``SHOP_PRODUCT_CACHE_SECONDS`` is zero.
+    """
+    timeout = settings.SHOP_PRODUCT_CACHE_SECONDS
+    if not timeout:
+        return build(product)
+    version = product_versions([product.id])[product.id]
+    key = PRODUCT_CONTEXT_KEY % (product.id, version)
+    context = cache.get(key)
+    if context is None:
+        context = build(product)
+        cache.set(key, context, timeout)
+    return context
+
+
+def invalidate_discounts():
+    """
+    Invalidates the cached SKUs for all discounts.
+    """
+    bump_version(DISCOUNT_VERSION_KEY)
+
+
+def discount_skus(discount, load):
+    """
+    Returns the cached SKUs the given discount applies to, calling
+    ``load`` with the discount to get them if they aren't cached or
+    ``SHOP_DISCOUNT_CACHE_SECONDS`` is zero.
+    """
+    timeout = settings.SHOP_DISCOUNT_CACHE_SECONDS
+    if not timeout:
+        return load(discount)
+    version = cache.get(DISCOUNT_VERSION_KEY, 0)
+    key = DISCOUNT_SKUS_KEY % (discount._meta.model_name, discount.id,
+                               version)
+    # Wrapped in a tuple, since ``None`` is a valid value.
+    cached = cache.get(key)
+    if cached is None:
+        cached = (load(discount),)
+        cache.set(key, cached, timeout)
+    return cached[0]
@@ -0,0 +1,199 @@
+"""
+Cart storage for anonymous shoppers. With the ``SHOP_CART_STORAGE``
+setting set to ``session`` or ``cache``, carts for anonymous shoppers
+are kept in the session or the Django cache rather than the ``Cart``
+and ``CartItem`` tables, and only written to the database when
+checkout starts, or the shopper logs in. Stored carts don't reserve
+stock until they're written to the database.
+"""
+from __future__ import unicode_literals
+from future.builtins import str
+
+from decimal import Decimal
+from time import time
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.encoding import force_text
+from django.utils.timezone import now
+from mezzanine.conf import settings
+
+from cartridge.shop import managers
+from cartridge.shop.models import Cart, CartBase, CartItem
+
+
+CACHE_KEY = "cartridge-cart-%s"
+
+# Fields of each item stored.
+ITEM_FIELDS = ("sku", "description", "quantity", "unit_price", "url",
+               "image", "can_ship")
+
+
+def cart_from_request(request):
+    """
+    Returns the cart for the given request - a ``StoredCart`` for
+    anonymous shoppers if enabled by ``SHOP_CART_STORAGE``, otherwise
+    a ``Cart`` model instance with its summary assigned. A stored
+    cart is written to the database once the shopper has logged in.
+    """
+    storage = settings.SHOP_CART_STORAGE
+    if storage != "database" and not request.session.get("cart"):
+        cart = StoredCart(request, storage)
+        if not request.user.is_authenticated():
+            return cart
+        if cart.has_items():
+            return cart.persist()
+    return summarized(request, Cart.objects.from_request(request))
+
+
+def summarized(request, cart):
+    """
+    Assigns the summary of the given ``Cart`` model instance's items
+    stored in the session by ``recalculate_cart``, so its template
+    helpers don't need to load its items. A new cart has no items, so
+    is given an empty summary.
+    """
+    summary = request.session.get("cart_summary")
+    if not cart.id:
+        cart.summary = {"items": 0, "quantity": 0, "total": 0,
+                        "ship": False}
+    elif summary and summary["cart"] == cart.id:
+        cart.summary = dict(summary, total=Decimal(summary["total"]))
+        del cart.summary["cart"]
+    return cart
+
+
+def persist_cart(request):
+    """
+    Writes the request's cart to the database if it's a stored cart,
+    called when checkout starts.
+    """
+    if isinstance(request.cart, StoredCart) and request.cart.has_items():
+        request.cart = request.cart.persist()
+
+
+class StoredCart(CartBase):
+    """
+    A cart kept in the session or the cache, with the same interface
+    as the ``Cart`` model. Its items are unsaved ``CartItem``
+    instances.
+    """
+
+    id = pk = None
+    unconfirmed = False
+
+    def __init__(self, request, storage):
+        self._request = request
+        self._storage = storage
+        self.last_updated = now()
+        expiry = settings.SHOP_CART_EXPIRY_MINUTES * 60
+        data = self._load() or {}
+        items = []
+        if time() - data.get("updated", 0) < expiry:
+            items = data.get("items", [])
+        self._cached_items = []
+        for fields in items:
+            fields = dict(fields, unit_price=Decimal(fields["unit_price"]))
+            self._cached_items.append(self._item(**fields))
+
+    def __iter__(self):
+        return iter(self._cached_items)
+
+    def _item(self, **fields):
+        item = CartItem(**fields)
+        item.total_price = item.unit_price * item.quantity
+        return item
+
+    def _key(self):
+        """
+        Returns the cache key for the cart. A random token is stored
+        in the session rather than using the session key, since the
+        session key changes when logging in.
+        """
+        token = self._request.session.get("cart_token")
+        if token is None:
+            token = self._request.session["cart_token"] = uuid4().hex
+        return CACHE_KEY % token
+
+    def _load(self):
+        if self._storage == "cache":
+            return cache.get(self._key())
+        return self._request.session.get("cart_items")
+
+    def save(self):
+        """
+        Writes the cart's items to its storage.
+        """
+        items = [dict([(f, getattr(item, f)) for f in ITEM_FIELDS])
+                 for item in self._cached_items if item.quantity > 0]
+        for item in items:
+            item["unit_price"] = str(item["unit_price"])
+        data = {"updated": time(), "items": items}
+        if self._storage == "cache":
+            timeout = settings.SHOP_CART_EXPIRY_MINUTES * 60
+            cache.set(self._key(), data, timeout)
+        else:
+            self._request.session["cart_items"] = data
+
+    def add_item(self, variation, quantity):
+        """
+        Increase quantity of existing item if SKU and price match,
+        otherwise add a new item.
+        """
+        unit_price = variation.price()
+        for item in self:
+            if item.sku == variation.sku and item.unit_price == unit_price:
+                break
+        else:
+            can_ship = bool(variation.product.category_flags &
+                            managers.CATEGORY_FLAG_PRINT)
+            item = self._item(sku=variation.sku, unit_price=unit_price,
+                              description=force_text(variation),
+                              url=variation.product.get_absolute_url(),
+                              can_ship=can_ship, quantity=0)
+            image = variation.image
+            if image is not None:
+                item.image = force_text(image.file)
+            self._cached_items.append(item)
+            variation.product.actions.added_to_cart()
+        item.quantity += quantity
+        item.total_price = item.unit_price * item.quantity
+        self.save()
+
+    def update_quantities(self, quantities):
+        """
+        Given a dict of SKUs and quantities, sets the quantity of each
+        item, removing items with a quantity of zero.
+        """
+        for item in self:
+            if item.sku in quantities:
+                item.quantity = quantities[item.sku]
+                item.total_price = item.unit_price * item.quantity
+        self._cached_items = [item for item in self if item.quantity > 0]
+        self.save()
+
+    def delete(self):
+        """
+        Removes all items from the cart.
+        """
+        self._cached_items = []
+        if self._storage == "cache":
+            cache.delete(self._key())
+        else:
+            self._request.session.pop("cart_items", None)
+
+    def persist(self):
+        """
+        Writes the cart and its items to the database, reserving their
+        stock, removes them from storage, and returns the ``Cart``
+        model instance.
+        """
+        with transaction.atomic():
+            cart = Cart.objects.create(last_updated=now())
+            for item in self:
+                item.cart = cart
+                item.save()
+        self.delete()
+        self._request.session["cart"] = cart.id
+        return cart
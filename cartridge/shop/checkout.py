@@ -2,6 +2,13 @@
 Checkout process utilities.
 """
 from __future__ import unicode_literals
+from future.builtins import str
+
+from hashlib import md5
+from json import dumps
+from logging import getLogger
+from threading import Lock
+from time import time
 
 from django.utils.translation import ugettext_lazy as _
 from django.template.loader import get_template, TemplateDoesNotExist
@@ -9,11 +16,48 @@ from mezzanine.accounts import get_profile_for_user, ProfileNotConfigured
 
 from mezzanine.conf import settings
 from mezzanine.utils.email import send_mail_template
+from mezzanine.utils.importing import import_dotted_path
 
 from cartridge.shop.models import Order
 from cartridge.shop.utils import set_shipping, set_tax, sign
 
 
+logger = getLogger(__name__)
+
+# Checkout handler functions imported by ``handler``, keyed by their
+# dotted paths.
+_handlers = {}
+
+# Inputs that checkout handlers can list in an ``inputs`` attribute,
+# mapped to functions returning the value of each for a request. A
+# handler that lists its inputs is only called again when the cart
+# is modified if one of them has changed since it was last called.
+HANDLER_INPUTS = {
+    # SKUs, quantities and prices of the cart's items.
+    "items": lambda request: sorted([(item.sku, item.quantity,
+                                      str(item.unit_price))
+                                     for item in request.cart]),
+    # The discount code and its total.
+    "discount": lambda request: [request.session.get(name) for name in
+                                 ("discount_code", "discount_total",
+                                  "free_shipping")],
+    # The shipping type and total.
+    "shipping": lambda request: [request.session.get(name) for name in
+                                 ("shipping_type", "shipping_total")],
+    # The tax type and total.
+    "tax": lambda request: [request.session.get(name) for name in
+                            ("tax_type", "tax_total")],
+    # The billing and shipping details entered during checkout.
+    "order": lambda request: request.session.get("order"),
+}
+HANDLER_INPUTS_KEY = "checkout_handler_inputs"
+_timings_lock = Lock()
+
+# Number of calls and the total and slowest seconds taken by the
+# checkout handler for each setting name, recorded by ``handler``.
+handler_timings = {}
+
+
 class CheckoutError(Exception):
     """
     Should be raised in billing/shipping and payment handlers for
@@ -39,6 +83,8 @@ def default_billship_handler(request, order_form):
         set_shipping(request, _("Flat rate shipping"),
                      settings.SHOP_DEFAULT_SHIPPING_VALUE)
 
+default_billship_handler.inputs = ("discount", "shipping")
+
 
 def default_tax_handler(request, order_form):
     """
@@ -53,6 +99,8 @@ def default_tax_handler(request, order_form):
     settings.use_editable()
     set_tax(request, _("Tax"), 0)
 
+default_tax_handler.inputs = ("tax",)
+
 
 def default_payment_handler(request, order_form, order):
     """
@@ -76,6 +124,91 @@ def default_order_handler(request, order_form, order):
     pass
 
 
+def handler(setting_name):
+    """
+    Returns a function that calls the checkout handler given by the
+    dotted path in the setting with the given name. The setting is
+    read on each call so that changes to it take effect, but each
+    path is only imported once. The time taken by each call is
+    recorded in ``handler_timings``, and calls taking longer than
+    ``SHOP_HANDLER_WARNING_SECONDS`` are logged as warnings.
+    """
+    def call_handler(request, *args):
+        path, func = _resolve_handler(setting_name)
+        start = time()
+        try:
+            result = func(request, *args)
+        finally:
+            _record_timing(setting_name, path, time() - start)
+        inputs = _handler_inputs(request, func)
+        if inputs is not None:
+            stored = dict(request.session.get(HANDLER_INPUTS_KEY, {}))
+            stored[setting_name] = [path, inputs]
+            request.session[HANDLER_INPUTS_KEY] = stored
+        return result
+    call_handler.setting_name = setting_name
+    return call_handler
+
+
+def call_handler_if_changed(checkout_handler, request, order_form):
+    """
+    Calls the given checkout handler, as returned by ``handler``,
+    unless the handler lists its inputs in an ``inputs`` attribute,
+    and none of them have changed in the request's session since it
+    was last called. See ``HANDLER_INPUTS`` for the names of inputs
+    that can be listed.
+    """
+    path, func = _resolve_handler(checkout_handler.setting_name)
+    inputs = _handler_inputs(request, func)
+    stored = request.session.get(HANDLER_INPUTS_KEY, {})
+    if inputs is None or stored.get(checkout_handler.setting_name) != [
+            path, inputs]:
+        checkout_handler(request, order_form)
+
+
+def _resolve_handler(setting_name):
+    path = getattr(settings, setting_name)
+    try:
+        func = _handlers[path]
+    except KeyError:
+        func = import_dotted_path(path) if path else lambda *args: None
+        _handlers[path] = func
+    return path, func
+
+
+def _handler_inputs(request, func):
+    """
+    Returns a digest of the values of the inputs listed in the given
+    handler's ``inputs`` attribute, or ``None`` if it doesn't have one.
+    """
+    names = getattr(func, "inputs", None)
+    if names is None:
+        return None
+    values = [HANDLER_INPUTS[name](request) for name in names]
+    values = dumps(values, sort_keys=True, default=str)
+    return md5(values.encode("utf-8")).hexdigest()
+
+
+def _record_timing(setting_name, path, seconds):
+    with _timings_lock:
+        timing = handler_timings.setdefault(setting_name,
+                                            {"calls": 0, "seconds": 0,
+                                             "slowest": 0})
+        timing["calls"] += 1
+        timing["seconds"] += seconds
+        timing["slowest"] = max(timing["slowest"], seconds)
+    warning_seconds = settings.SHOP_HANDLER_WARNING_SECONDS
+    if warning_seconds and seconds > warning_seconds:
+        logger.warning("Checkout handler %s took %.2f seconds",
+                       path, seconds)
+
+
+billship_handler = handler("SHOP_HANDLER_BILLING_SHIPPING")
+tax_handler = handler("SHOP_HANDLER_TAX")
+payment_handler = handler("SHOP_HANDLER_PAYMENT")
+order_handler = handler("SHOP_HANDLER_ORDER")
+
+
 def initial_order_data(request, form_class=None, express=False):
     """
     Return the initial data for the order form, trying the following in
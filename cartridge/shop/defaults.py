@@ -86,6 +86,35 @@ register_setting(
     default=30,
 )
 
+register_setting(
+    name="SHOP_PRODUCT_ACTION_BUFFER",
+    description="Buffer increments of the product action counters used "
+        "for popularity, rather than writing them to the database on each "
+        "add to cart and purchase. Either ``memory`` to buffer in each "
+        "process, ``cache`` to buffer in the shared Django cache and allow "
+        "the ``flush_product_actions`` command to write them, or empty to "
+        "disable buffering.",
+    editable=False,
+    default="",
+)
+
+register_setting(
+    name="SHOP_PRODUCT_ACTION_FLUSH_INTERVAL",
+    description="Maximum number of seconds between writing buffered "
+        "product action counters to the database.",
+    editable=False,
+    default=60,
+)
+
+register_setting(
+    name="SHOP_PRODUCT_ACTION_BUFFER_MAX",
+    description="Maximum number of buffered product action increments "
+        "before they're written to the database, which bounds the number "
+        "lost if a process exits or the cache is cleared.",
+    editable=False,
+    default=1000,
+)
+
 register_setting(
     name="SHOP_CATEGORY_USE_FEATURED_IMAGE",
     description=_("Enable featured images in shop categories"),
@@ -93,6 +122,47 @@ register_setting(
     default=False,
 )
 
+register_setting(
+    name="SHOP_CART_EXPIRE_INLINE",
+    description="If ``True``, expired carts are deleted whenever a cart "
+        "is updated during a request. Set to ``False`` when running the "
+        "``expire_carts`` command periodically instead.",
+    editable=False,
+    default=True,
+)
+
+register_setting(
+    name="SHOP_CART_HEARTBEAT_FRACTION",
+    description="Fraction of ``SHOP_CART_EXPIRY_MINUTES`` that must pass "
+        "before a cart's last updated time is written to the database "
+        "again, using the last time it was written stored in the session. "
+        "For example ``0.1`` with the default expiry writes it at most "
+        "every three minutes, and carts may be treated as expired up to "
+        "three minutes early. Zero writes it on every request.",
+    editable=False,
+    default=0,
+)
+
+register_setting(
+    name="SHOP_CART_STORAGE",
+    description="Where carts for anonymous shoppers are kept: "
+        "``database`` for the ``Cart`` model, or ``session`` or ``cache`` "
+        "to keep them out of the database until checkout starts or the "
+        "shopper logs in. Carts kept in the session or cache don't "
+        "reserve stock.",
+    editable=False,
+    default="database",
+)
+
+register_setting(
+    name="SHOP_CART_SKIP_URL_PREFIXES",
+    description="Sequence of URL prefixes, such as static files or health "
+        "checks, for which the cart isn't retrieved from the database and "
+        "an empty cart is used instead.",
+    editable=False,
+    default=(),
+)
+
 register_setting(
     name="SHOP_CHECKOUT_ACCOUNT_REQUIRED",
     label=_("Checkout account required"),
@@ -206,6 +276,17 @@ register_setting(
     default="cartridge.shop.checkout.default_payment_handler",
 )
 
+register_setting(
+    name="SHOP_HANDLER_WARNING_SECONDS",
+    description="Number of seconds a call to one of the checkout handlers "
+        "may take before it's logged as a warning. The number of calls "
+        "and time taken by each handler are also recorded in "
+        "``cartridge.shop.checkout.handler_timings``. Zero disables the "
+        "warnings.",
+    editable=False,
+    default=1,
+)
+
 register_setting(
     name="SHOP_OPTION_TYPE_CHOICES",
     description="Sequence of value/name pairs for types of product options "
@@ -270,6 +351,57 @@ register_setting(
     default=12,
 )
 
+register_setting(
+    name="SHOP_KEYSET_PAGINATION",
+    description="If ``True``, category product listings and order "
+        "history are paged with a cursor for the next page, rather than "
+        "page numbers. This avoids counting all of the items and "
+        "skipping over previous pages, which is slow for large "
+        "catalogues and deep pages.",
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="SHOP_POPULARITY_HALF_LIFE",
+    description="Number of days after which a product's adds to cart and "
+        "purchases count half as much towards its popularity. Run the "
+        "``rebuild_popularity`` command after changing this.",
+    editable=False,
+    default=14,
+)
+
+register_setting(
+    name="SHOP_POPULARITY_WEIGHTS",
+    description="Dict mapping product action fields to how much each "
+        "action counts towards a product's popularity. Run the "
+        "``rebuild_popularity`` command after changing this.",
+    editable=False,
+    default={"total_cart": 1, "total_purchase": 5},
+)
+
+register_setting(
+    name="SHOP_DISCOUNT_CACHE_SECONDS",
+    description="Number of seconds to cache the SKUs that each discount "
+        "code and sale applies to, or zero to disable caching. Cached "
+        "SKUs are invalidated when discounts, products or categories "
+        "change, so a cache backend shared between processes should be "
+        "configured.",
+    editable=False,
+    default=0,
+)
+
+register_setting(
+    name="SHOP_PRODUCT_CACHE_SECONDS",
+    description="Number of seconds to cache the variations, images, "
+        "related products and form options for product pages viewed by "
+        "non-staff users, or zero to disable caching. Cached pages are "
+        "invalidated when products change, so a cache backend shared "
+        "between processes should be configured.",
+    editable=False,
+    default=0,
+)
+
 register_setting(
     name="SHOP_PRODUCT_SORT_OPTIONS",
     description="Sequence of description/field+direction pairs defining "
@@ -280,6 +412,7 @@ register_setting(
         (_("Most expensive"), "-unit_price"),  
         
         (_("Highest rated"), "-rating_average"),
+        (_("Most popular"), "-popularity"),
         (_("Least expensive"), "unit_price"),
         
     ),
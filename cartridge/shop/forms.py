@@ -6,6 +6,7 @@ from future.utils import with_metaclass
 from collections import OrderedDict
 from copy import copy
 from datetime import date
+from decimal import Decimal
 from itertools import dropwhile, takewhile
 from locale import localeconv
 from re import match
@@ -23,6 +24,7 @@ from mezzanine.core.templatetags.mezzanine_tags import thumbnail
 from cartridge.shop import checkout,fields
 from cartridge.shop.models import Product, ProductOption, ProductVariation
 from cartridge.shop.models import Cart, CartItem, Order, DiscountCode
+from cartridge.shop.models import DiscountReservation
 from cartridge.shop.utils import (make_choices, set_locale, set_shipping,
                                   clear_session)
 from filebrowser_safe.fields import FileBrowseWidget
@@ -87,15 +89,22 @@ class AddProductForm(forms.Form):
         """
         self._product = kwargs.pop("product", None)
         self._to_cart = kwargs.pop("to_cart")
+        category_keywords = kwargs.pop("category_keywords", None)
+        option_values = kwargs.pop("option_values", None)
         super(AddProductForm, self).__init__(*args, **kwargs)
         # Adding from the wishlist with a sku, bail out.
         if args[0] is not None and args[0].get("sku", None):
             return
         # Adding from the product page, remove the sku field
-        # and build the choice fields for the variations.
+        # and build the choice fields for the variations. The
+        # keywords of the product's categories and the option values
+        # of its variations may be given, eg when cached by the view.
         if self._product:
-            for cat in self._product.categories.all():
-                if 'subscription' in cat.keywords_string:
+            if category_keywords is None:
+                category_keywords = [cat.keywords_string for cat in
+                                     self._product.categories.all()]
+            for keywords in category_keywords:
+                if 'subscription' in keywords:
                     self.fields['quantity'].label='Users'
                 else:
                     self.fields['quantity'].widget=forms.widgets.HiddenInput()
@@ -105,8 +114,9 @@ class AddProductForm(forms.Form):
             return
         option_names, option_labels = list(zip(*[(f.name, f.verbose_name)
             for f in option_fields]))
-        option_values = list(zip(*self._product.variations.filter(
-            unit_price__isnull=False).values_list(*option_names)))
+        if option_values is None:
+            option_values = list(zip(*self._product.variations.filter(
+                unit_price__isnull=False).values_list(*option_names)))
         if option_values:
             for i, name in enumerate(option_names):
                 values = [_f for _f in set(option_values[i]) if _f]
@@ -171,21 +181,199 @@ class CartItemForm(forms.ModelForm):
 #             if not 'subscription' in cat.keywords_string:
 #        self.fields['quantity'].widget.attrs['readonly']=True
 
+    # Dict of SKUs mapped to variations with their live stock levels
+    # loaded, assigned by ``BaseCartItemFormSet`` for all of the
+    # forms in the cart at once.
+    variations = None
+
     def clean_quantity(self):
         """
         Validate that the given quantity is available.
         """
-        variation = ProductVariation.objects.get(sku=self.instance.sku)
+        try:
+            variation = self.variations[self.instance.sku]
+        except (KeyError, TypeError):
+            variation = ProductVariation.objects.get(sku=self.instance.sku)
         quantity = self.cleaned_data["quantity"]
         if not variation.has_stock(quantity - self.instance.quantity):
             error = ADD_PRODUCT_ERRORS["no_stock_quantity"].rstrip(".")
             raise forms.ValidationError("%s: %s" % (error, quantity))
         return quantity
 
+
+class PreloadedChoiceField(forms.ModelChoiceField):
+    """
+    Model choice field that validates against a sequence of model
+    instances that have already been loaded, rather than querying for
+    the selected instance.
+    """
+
+    def __init__(self, instances, *args, **kwargs):
+        self.instances = dict([(str(i.pk), i) for i in instances])
+        super(PreloadedChoiceField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.instances[str(value)]
+        except KeyError:
+            error = self.error_messages["invalid_choice"]
+            raise forms.ValidationError(error, code="invalid_choice")
+
+
+class BaseCartItemFormSet(BaseInlineFormSet):
+    """
+    Formset for the items in the cart, which loads the variation and
+    live stock level for every item in the cart up front and gives
+    them to each form, so that the number of queries performed when
+    validating the cart doesn't grow with the number of items.
+    """
+
+    def add_fields(self, form, index):
+        """
+        Validate each item's ID against the cart items already loaded
+        by the formset, rather than querying for each item.
+        """
+        super(BaseCartItemFormSet, self).add_fields(form, index)
+        name = self._pk_field.name
+        field = form.fields[name]
+        form.fields[name] = PreloadedChoiceField(self.get_queryset(),
+            field.queryset, initial=field.initial, required=False,
+            widget=field.widget)
+
+    def _construct_form(self, i, **kwargs):
+        form = super(BaseCartItemFormSet, self)._construct_form(i, **kwargs)
+        form.variations = self.variations
+        return form
+
+    @property
+    def variations(self):
+        """
+        Dict of SKUs mapped to the variation for each item in the
+        cart, with their live stock levels loaded.
+        """
+        if not hasattr(self, "_variations"):
+            skus = [item.sku for item in self.get_queryset()]
+            variations = ProductVariation.objects.filter(sku__in=skus)
+            variations = list(variations)
+            ProductVariation.objects.live_stock(variations)
+            self._variations = dict([(v.sku, v) for v in variations])
+        return self._variations
+
+
 CartItemFormSet = inlineformset_factory(Cart, CartItem, form=CartItemForm,
+                                        formset=BaseCartItemFormSet,
                                         can_delete=True, extra=0)
 
 
+class StoredCartItemForm(forms.Form):
+    """
+    Form for each item in a cart kept in the session or cache - used
+    for the ``StoredCartItemFormSet`` below, in place of
+    ``CartItemFormSet`` which edits ``CartItem`` instances.
+    """
+
+    # Named ``id`` to match the hidden field rendered for each
+    # ``CartItemForm`` in templates, but holds the item's SKU.
+    id = forms.CharField(widget=forms.HiddenInput())
+    quantity = forms.IntegerField(label=_("Quantity"), min_value=0)
+
+    # Assigned by ``BaseStoredCartItemFormSet``, as per ``CartItemForm``.
+    instance = None
+    variations = None
+    skus = None
+
+    def clean_id(self):
+        """
+        Validate that the given SKU is in the cart.
+        """
+        sku = self.cleaned_data["id"]
+        if sku not in self.skus:
+            raise forms.ValidationError(_("Invalid cart item."))
+        return sku
+
+    def clean_quantity(self):
+        """
+        Validate that the given quantity is available.
+        """
+        quantity = self.cleaned_data["quantity"]
+        sku = self.cleaned_data.get("id")
+        if sku is None:
+            # Invalid SKU, already reported by ``clean_id``.
+            return quantity
+        try:
+            variation = self.variations[sku]
+        except KeyError:
+            raise forms.ValidationError(
+                ADD_PRODUCT_ERRORS["invalid_options"])
+        if not variation.has_stock(quantity):
+            error = ADD_PRODUCT_ERRORS["no_stock_quantity"].rstrip(".")
+            raise forms.ValidationError("%s: %s" % (error, quantity))
+        return quantity
+
+
+class BaseStoredCartItemFormSet(forms.BaseFormSet):
+    """
+    Formset for editing the items in a cart kept in the session or
+    cache, taking the cart as an ``instance`` argument like
+    ``CartItemFormSet``.
+    """
+
+    def __init__(self, data=None, instance=None, **kwargs):
+        self.instance = instance
+        self.items = list(instance)
+        kwargs["initial"] = [{"id": item.sku, "quantity": item.quantity}
+                             for item in self.items]
+        super(BaseStoredCartItemFormSet, self).__init__(data, **kwargs)
+
+    @classmethod
+    def get_default_prefix(cls):
+        return "items"
+
+    def total_form_count(self):
+        return len(self.items)
+
+    def _construct_form(self, i, **kwargs):
+        form = super(BaseStoredCartItemFormSet, self)._construct_form(
+            i, **kwargs)
+        form.instance = self.items[i]
+        form.variations = self.variations
+        form.skus = set([item.sku for item in self.items])
+        return form
+
+    @property
+    def variations(self):
+        """
+        Dict of SKUs mapped to the variation for each item in the
+        cart, with their live stock levels loaded.
+        """
+        if not hasattr(self, "_variations"):
+            skus = [item.sku for item in self.items]
+            variations = ProductVariation.objects.filter(sku__in=skus)
+            variations = list(variations)
+            ProductVariation.objects.live_stock(variations)
+            self._variations = dict([(v.sku, v) for v in variations])
+        return self._variations
+
+    def save(self):
+        """
+        Update the quantities of the cart's items, removing deleted
+        items.
+        """
+        quantities = {}
+        for form in self.forms:
+            quantity = form.cleaned_data["quantity"]
+            if form.cleaned_data.get("DELETE"):
+                quantity = 0
+            quantities[form.cleaned_data["id"]] = quantity
+        self.instance.update_quantities(quantities)
+
+
+StoredCartItemFormSet = forms.formset_factory(StoredCartItemForm,
+    formset=BaseStoredCartItemFormSet, can_delete=True, extra=0)
+
+
 class FormsetForm(object):
     """
     Form mixin that provides template methods for iterating through
@@ -307,11 +495,21 @@ class DiscountForm(forms.ModelForm):
         """
         discount = getattr(self, "_discount", None)
         if discount is not None:
+            reservations = DiscountReservation.objects
+            if not reservations.reserve(discount.code, self._request.cart):
+                # The last use of the code was reserved by another
+                # cart since it was validated.
+                self.add_error("discount_code", _("The discount code "
+                                                  "entered is no longer "
+                                                  "available."))
+                return
             # Clear out any previously defined discount code
             # session vars.
             names = ("free_shipping", "discount_code", "discount_total")
             clear_session(self._request, *names)
-            total = self._request.cart.calculate_discount(discount)
+            cart = self._request.cart
+            discount_skus = cart.discount_skus(discount)
+            total = cart.discount_total(discount, discount_skus)
             if discount.free_shipping:
                 set_shipping(self._request, _("Free shipping"), 0)
             else:
@@ -323,6 +521,56 @@ class DiscountForm(forms.ModelForm):
             self._request.session["free_shipping"] = discount.free_shipping
             self._request.session["discount_code"] = discount.code
             self._request.session["discount_total"] = str(total)
+            # Store what the discount applies to, so that changes to
+            # the cart can be checked against it without validating
+            # the code again - see ``cached_discount_total``.
+            skus = None
+            if discount_skus is not None:
+                skus = dict([(sku, sku in discount_skus)
+                             for sku in cart.skus()])
+            money = lambda value: None if value is None else str(value)
+            self._request.session["discount_applicability"] = {
+                "code": discount.code,
+                "min_purchase": money(discount.min_purchase),
+                "discount_deduct": money(discount.discount_deduct),
+                "discount_percent": money(discount.discount_percent),
+                "skus": skus,
+            }
+
+
+def cached_discount_total(request):
+    """
+    Returns the total of the discount code stored in the session for
+    the request's cart, calculated from what the code was found to
+    apply to when it was last validated, or ``None`` if that doesn't
+    cover the cart - its minimum purchase isn't met, or the cart
+    contains SKUs the code wasn't checked against - in which case the
+    code needs to be validated again.
+    """
+    applicability = request.session.get("discount_applicability")
+    code = request.session.get("discount_code")
+    if not applicability or applicability["code"] != code:
+        return None
+    cart = request.cart
+    min_purchase = applicability["min_purchase"]
+    if min_purchase is not None:
+        if cart.total_price() < Decimal(min_purchase):
+            return None
+    skus = applicability["skus"]
+    if skus is not None:
+        cart_skus = cart.skus()
+        if not set(cart_skus) <= set(skus):
+            return None
+        discount_skus = set([sku for sku in cart_skus if skus[sku]])
+        if not discount_skus:
+            return None
+    else:
+        discount_skus = None
+    money = lambda value: None if value is None else Decimal(value)
+    discount = DiscountCode(
+        discount_deduct=money(applicability["discount_deduct"]),
+        discount_percent=money(applicability["discount_percent"]))
+    return cart.discount_total(discount, discount_skus)
 
 
 class OrderForm(FormsetForm, DiscountForm):
@@ -0,0 +1,55 @@
+from __future__ import division, unicode_literals
+
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.utils.translation import ugettext as _
+from mezzanine.conf import settings
+
+from cartridge.shop.models import Product
+from cartridge.shop.utils import keyset_paginate
+
+
+class Command(BaseCommand):
+    help = _("Compare the time taken to load the first and a deep page "
+             "of products, with page number and keyset pagination.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--page',
+            type='int',
+            dest='page',
+            default=500,
+            help=_('Deep page number to load.')),
+        make_option('--sort',
+            dest='sort',
+            default=None,
+            help=_('Field to sort by, defaults to the first option in '
+                   'SHOP_PRODUCT_SORT_OPTIONS.')),
+    )
+
+    def handle(self, *args, **options):
+        sort_by = options["sort"] or settings.SHOP_PRODUCT_SORT_OPTIONS[0][1]
+        per_page = settings.SHOP_PER_PAGE_CATEGORY
+        products = Product.objects.published()
+        for page in (1, options["page"]):
+            start = time()
+            paginator = Paginator(products.order_by(sort_by), per_page)
+            list(paginator.page(page).object_list)
+            self.report(_("Page number"), page, time() - start)
+            # Walk to the deep page untimed, since keyset pagination
+            # only reaches it by following each page's cursor.
+            cursor = None
+            for i in range(page - 1):
+                cursor = keyset_paginate(products, sort_by, cursor,
+                                         per_page).next_cursor
+                if cursor is None:
+                    break
+            start = time()
+            keyset_paginate(products, sort_by, cursor, per_page)
+            self.report(_("Keyset"), page, time() - start)
+
+    def report(self, name, page, seconds):
+        self.stdout.write("%s, page %s: %.2fms" % (name, page,
+                                                   seconds * 1000))
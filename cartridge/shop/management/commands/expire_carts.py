@@ -0,0 +1,40 @@
+from __future__ import division, unicode_literals
+
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.models import Cart
+
+
+class Command(BaseCommand):
+    help = _("Delete expired carts in batches. Intended to be run "
+             "periodically when the SHOP_CART_EXPIRE_INLINE setting is "
+             "False.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help=_('Number of carts to delete in each batch.')),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        start = time()
+        total = 0
+        for deleted in Cart.objects.delete_expired(options["batch_size"]):
+            total += deleted
+            if verbosity > 1:
+                self.report(total, start)
+        if verbosity > 0:
+            self.report(total, start)
+
+    def report(self, total, start):
+        elapsed = time() - start
+        rate = total / elapsed if elapsed else total
+        self.stdout.write(_("Deleted %s expired carts (%.1f per second)") %
+                          (total, rate))
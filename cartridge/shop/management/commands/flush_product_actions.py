@@ -0,0 +1,15 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop import actions
+
+
+class Command(BaseCommand):
+    help = _("Write buffered product action counters to the database. "
+             "Intended to be run periodically when the "
+             "SHOP_PRODUCT_ACTION_BUFFER setting is 'cache'.")
+
+    def handle(self, *args, **options):
+        actions.flush()
@@ -1,23 +1,36 @@
-from __future__ import print_function
+from __future__ import division, print_function
 
 import csv
+import gzip
+import json
 import os
 import shutil
-import sys
 import datetime
+from decimal import Decimal
+from hashlib import md5
 from optparse import make_option
+from time import time
 
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import force_bytes, force_text
+from django.utils.timezone import make_aware
 from django.utils.translation import ugettext as _
-from django.db.utils import IntegrityError
+from django.db import transaction
+from django.db.models import AutoField, Count, Min, Prefetch
+from future.utils import PY2
 from mezzanine.conf import settings
 
+from cartridge.shop import caching
+from cartridge.shop.models import Priced
 from cartridge.shop.models import Product
 from cartridge.shop.models import ProductOption
 from cartridge.shop.models import ProductImage
 from cartridge.shop.models import ProductVariation
 from cartridge.shop.models import Category
+from cartridge.shop.utils import case_update
+from mezzanine.core.models import CONTENT_STATUS_DRAFT
 from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
 
 
@@ -75,11 +88,33 @@ class Command(BaseCommand):
             dest='export',
             default=False,
             help=_('Export products from csv file.')),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=250,
+            help=_('Number of rows to import in each transaction, or '
+                   'to load in each query when exporting.')),
+        make_option('--format',
+            type='choice',
+            choices=['csv', 'ndjson'],
+            dest='format',
+            default='csv',
+            help=_('Format to export to, csv or ndjson. Files ending in '
+                   '.gz are compressed with gzip.')),
+        make_option('--upsert',
+            action='store_true',
+            dest='upsert',
+            default=False,
+            help=_('Update variations with existing SKUs, skipping '
+                   'unchanged rows.')),
+        make_option('--unpublish-missing',
+            action='store_true',
+            dest='unpublish_missing',
+            default=False,
+            help=_('Unpublish products not in the csv file.')),
     )
 
     def handle(self, *args, **options):
-        if sys.version_info[0] == 3:
-            raise CommandError("Python 3 not supported")
         try:
             csv_file = args[0]
         except IndexError:
@@ -89,30 +124,14 @@ class Command(BaseCommand):
         if not options["import"] and not options["export"]:
             raise CommandError(_("need to import or export"))
         if options['import']:
-            import_products(csv_file)
+            import_products(csv_file, options['batch_size'],
+                            options['upsert'], options['unpublish_missing'])
         elif options['export']:
-            export_products(csv_file)
-
-
-def _product_from_row(row):
-    product, created = Product.objects.get_or_create(title=row[TITLE])
-    product.content = row[CONTENT]
-    product.description = row[DESCRIPTION]
-    # TODO: set the 2 below from spreadsheet.
-    product.status = CONTENT_STATUS_PUBLISHED
-    product.available = True
-    # TODO: allow arbitrary level/number of categories.
-    base_cat, created = Category.objects.get_or_create(title=row[CATEGORY])
-    sub_cat, created = Category.objects.get_or_create(
-        title=row[SUB_CATEGORY],
-        parent=base_cat)
-    product.categories.add(sub_cat)
-    shop_cat, created = Category.objects.get_or_create(title="Shop")
-    product.categories.add(shop_cat)
-    return product
-
-
-def _make_image(image_str, product):
+            export_products(csv_file, options['format'],
+                            options['batch_size'])
+
+
+def _make_image(image_str, product_id):
     if image_str in EMPTY_IMAGE_ENTRIES:
         return None
     # try adding various image suffixes, if none given in original filename.
@@ -127,103 +146,446 @@ def _make_image(image_str, product):
     image, created = ProductImage.objects.get_or_create(
         file="%s" % (os.path.join(SITE_MEDIA_IMAGE_DIR, image_str)),
         description=image_str,  # TODO: handle column for this.
-        product=product)
+        product_id=product_id)
     return image
 
 
 def _make_date(date_str, time_str):
     date_string = '%s %s' % (date_str, time_str)
     date = datetime.datetime.strptime(date_string, DATETIME_FORMAT)
+    if settings.USE_TZ:
+        date = make_aware(date)
     return date
 
 
-def import_products(csv_file):
-    print(_("Importing .."))
-    # More appropriate for testing.
-    # Product.objects.all().delete()
-    reader = csv.DictReader(open(csv_file), delimiter=',')
-    for row in reader:
-        print(row)
-        product = _product_from_row(row)
-        try:
-            variation = ProductVariation.objects.create(
-                # strip whitespace
-                sku=row[SKU].replace(" ", ""),
-                product=product,
-            )
-        except IntegrityError:
-            raise CommandError("Product with SKU exists! sku: %s" % row[SKU])
+def _open(path, mode):
+    """
+    Opens the file for the csv module, which reads and writes bytes
+    on Python 2 and text on Python 3, using gzip if its name ends in
+    ``.gz``.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    if PY2:
+        return opener(path, mode + "b")
+    return opener(path, mode + "t", encoding="utf-8", newline="")
+
+
+def _read_rows(csv_file):
+    """
+    Yields each row of the csv file as a dict, reading it a line at a
+    time rather than loading the whole file.
+    """
+    with _open(csv_file, "r") as f:
+        for row in csv.DictReader(f, delimiter=','):
+            yield dict([(k, force_text(v or "")) for k, v in row.items()])
+
+
+def _row_hash(row):
+    """
+    Returns a digest of the row's values, stored on its variation so
+    that unchanged rows can be skipped when upserting.
+    """
+    values = "\x1f".join([row.get(field, "") for field in fieldnames])
+    return md5(force_bytes(values)).hexdigest()
+
+
+def _changed(model, values):
+    """
+    Given a dict mapping IDs of the given model to dicts of field
+    values, returns a copy without the fields whose values are
+    unchanged, or the IDs with no changed fields, reading the current
+    values with a single query.
+    """
+    if not values:
+        return {}
+    names = set([name for fields in values.values() for name in fields])
+    changed = {}
+    for current in model.objects.filter(id__in=list(values)).values(
+            "id", *names):
+        fields = dict([(name, value)
+                       for name, value in values[current["id"]].items()
+                       if current[name] != value])
+        if fields:
+            changed[current["id"]] = fields
+    return changed
+
+
+class ProductImporter(object):
+    """
+    Imports csv rows in batches, each in its own transaction. The
+    categories, options, images, SKUs and products that already exist
+    are loaded into lookup maps up front, so that each batch only
+    queries the database to create what's missing, with
+    ``bulk_create`` for variations, options and category assignments,
+    and ``CASE`` updates for the fields of existing products. The work
+    ``manage_empty``, ``set_default_images`` and
+    ``copy_default_variation`` do for each product is done with
+    set-based queries for all of a batch's products.
+
+    When upserting, rows for existing SKUs update their variations
+    rather than raising ``CommandError``. Each variation stores a
+    hash of the row it was imported from, so rows that haven't
+    changed are skipped without any queries, and only fields that
+    have changed are written for the rest. Products not in the
+    feed can also be unpublished.
+    """
+
+    def __init__(self, batch_size, upsert=False):
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.created = self.updated = self.unchanged = self.unpublished = 0
+        self.feed_products = set()
+        self.products = dict(Product.objects.values_list("title", "id"))
+        self.skus = dict([(sku, (id, product_id, import_hash))
+                          for sku, id, product_id, import_hash in
+                          ProductVariation.objects.values_list(
+                              "sku", "id", "product_id", "import_hash")])
+        self.options = set(ProductOption.objects.values_list("type", "name"))
+        self.images = dict([((product_id, file), id) for id, product_id, file
+                            in ProductImage.objects.values_list(
+                                "id", "product_id", "file")])
+        self.categories = {}
+        self.subcategories = {}
+        for id, title, parent_id in Category.objects.values_list(
+                "id", "title", "parent_id").order_by("-id"):
+            self.categories[title] = id
+            self.subcategories[(title, parent_id)] = id
+        self.through = Product.categories.through
+        self.product_categories = set(self.through.objects.values_list(
+            "product_id", "category_id"))
+
+    def run(self, rows, unpublish_missing=False):
+        """
+        Imports the given rows, printing progress after each batch,
+        and unpublishing products not in the rows if specified.
+        """
+        start = time()
+        total = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                total += self.import_batch(batch)
+                self.report(total, start)
+                batch = []
+        if batch:
+            total += self.import_batch(batch)
+            self.report(total, start)
+        if unpublish_missing:
+            self.unpublish_missing()
+        print(_("Created: %s, updated: %s, unchanged: %s, unpublished: %s")
+              % (self.created, self.updated, self.unchanged,
+                 self.unpublished))
+        if self.created or self.updated or self.unpublished:
+            # Bulk queries don't send the signals that would otherwise
+            # keep these up to date.
+            Category.objects.update(membership_stale=True)
+            caching.invalidate_products()
+            caching.invalidate_discounts()
+
+    def report(self, total, start):
+        elapsed = time() - start
+        print(_("Imported %s rows (%.0f rows/sec)") %
+              (total, total / elapsed if elapsed else total))
+
+    def import_batch(self, rows):
+        """
+        Imports the given rows in a single transaction, returning the
+        number of rows imported.
+        """
+        with transaction.atomic():
+            self.product_fields = {}
+            self.variation_fields = {}
+            self.product_ids = set()
+            self.new_categories = set()
+            self.new_options = set()
+            variations = [self.variation_from_row(row) for row in rows]
+            variations = [v for v in variations if v is not None]
+            case_update(Product.objects.all(),
+                        _changed(Product, self.product_fields))
+            self.through.objects.bulk_create([
+                self.through(product_id=product_id, category_id=category_id)
+                for product_id, category_id in self.new_categories])
+            ProductOption.objects.bulk_create([
+                ProductOption(type=type, name=name)
+                for type, name in self.new_options])
+            for variation in variations:
+                # Variations without a SKU are given their ID as one,
+                # so need to be saved individually.
+                if not variation.sku:
+                    variation.save()
+            ProductVariation.objects.bulk_create([v for v in variations
+                                                  if v.sku])
+            case_update(ProductVariation.objects.all(),
+                        _changed(ProductVariation, self.variation_fields))
+            if self.product_ids:
+                self.manage_variations(self.product_ids)
+                Product.objects.update_category_flags(self.product_ids)
+        return len(rows)
+
+    def product_id(self, row):
+        """
+        Returns the ID for the row's product, creating it if it doesn't
+        exist, otherwise storing the row's fields to update it with.
+        """
+        fields = {"content": row[CONTENT], "description": row[DESCRIPTION],
+                  # TODO: set the 2 below from spreadsheet.
+                  "status": CONTENT_STATUS_PUBLISHED, "available": True}
+        product_id = self.products.get(row[TITLE])
+        if product_id is None:
+            product = Product.objects.create(title=row[TITLE], **fields)
+            product_id = self.products[row[TITLE]] = product.id
+        else:
+            self.product_fields[product_id] = fields
+        self.product_ids.add(product_id)
+        # TODO: allow arbitrary level/number of categories.
+        base_cat = self.category_id(row[CATEGORY])
+        sub_cat = self.category_id(row[SUB_CATEGORY], base_cat)
+        for category_id in (sub_cat, self.category_id("Shop")):
+            if (product_id, category_id) not in self.product_categories:
+                self.product_categories.add((product_id, category_id))
+                self.new_categories.add((product_id, category_id))
+        return product_id
+
+    def category_id(self, title, parent_id=None):
+        """
+        Returns the ID of the category with the given title, and parent
+        if given, creating it if it doesn't exist.
+        """
+        if parent_id is None:
+            category_id = self.categories.get(title)
+        else:
+            category_id = self.subcategories.get((title, parent_id))
+        if category_id is None:
+            category = Category.objects.create(title=title,
+                                               parent_id=parent_id)
+            category_id = category.id
+            self.categories.setdefault(title, category_id)
+            self.subcategories[(title, parent_id)] = category_id
+        return category_id
+
+    def image_id(self, image_str, product_id):
+        """
+        Returns the ID of the product's image for the given image
+        column, copying the image and creating it if it doesn't exist.
+        """
+        file = os.path.join(SITE_MEDIA_IMAGE_DIR, image_str)
+        image_id = self.images.get((product_id, file))
+        if image_id is None:
+            image = _make_image(image_str, product_id)
+            if image is None:
+                return None
+            image_id = self.images[(product_id, file)] = image.id
+        return image_id
+
+    def variation_from_row(self, row):
+        """
+        Returns an unsaved variation for the row if its SKU is new,
+        otherwise storing the row's fields to update the existing
+        variation with when upserting.
+        """
+        # strip whitespace
+        sku = row[SKU].replace(" ", "")
+        row_hash = _row_hash(row)
+        id, product_id, import_hash = self.skus.get(sku, (None, None, None))
+        if product_id is not None:
+            # SKUs repeated in the feed have no ID yet.
+            if not self.upsert or id is None:
+                raise CommandError("Product with SKU exists! sku: %s" %
+                                   row[SKU])
+            self.feed_products.add(product_id)
+            if import_hash == row_hash:
+                self.unchanged += 1
+                return None
+        fields = self.variation_fields_from_row(row)
+        self.feed_products.add(fields["product"])
+        if sku:
+            self.skus[sku] = (id, fields["product"], row_hash)
+        fields["import_hash"] = row_hash
+        if id is not None:
+            # The variation's previous product needs updating too, if
+            # it's moved to another.
+            self.product_ids.add(product_id)
+            self.variation_fields[id] = fields
+            self.updated += 1
+            return None
+        self.created += 1
+        attnames = dict([(ProductVariation._meta.get_field(name).attname,
+                          value) for name, value in fields.items()])
+        return ProductVariation(sku=sku, **attnames)
+
+    def variation_fields_from_row(self, row):
+        """
+        Returns a dict of the variation fields for the row, with blank
+        columns as ``None``, storing any new options it uses.
+        """
+        product_id = self.product_id(row)
+        fields = {"product": product_id,
+                  "image": self.image_id(row[IMAGE], product_id)}
+        fields["num_in_stock"] = None
         if row[NUM_IN_STOCK]:
-            variation.num_in_stock = row[NUM_IN_STOCK]
-        if row[UNIT_PRICE]:
-            variation.unit_price = row[UNIT_PRICE]
-        if row[SALE_PRICE]:
-            variation.sale_price = row[SALE_PRICE]
+            fields["num_in_stock"] = int(row[NUM_IN_STOCK])
+        for name, column in (("unit_price", UNIT_PRICE),
+                             ("sale_price", SALE_PRICE)):
+            fields[name] = Decimal(row[column]) if row[column] else None
+        fields["sale_from"] = fields["sale_to"] = None
         if row[SALE_START_DATE] and row[SALE_START_TIME]:
-            variation.sale_from = _make_date(row[SALE_START_DATE],
-                                                row[SALE_START_TIME])
+            fields["sale_from"] = _make_date(row[SALE_START_DATE],
+                                             row[SALE_START_TIME])
         if row[SALE_END_DATE] and row[SALE_END_TIME]:
-            variation.sale_to = _make_date(row[SALE_END_DATE],
-                                                row[SALE_END_TIME])
+            fields["sale_to"] = _make_date(row[SALE_END_DATE],
+                                           row[SALE_END_TIME])
         for option in TYPE_CHOICES:
+            name = "option%s" % TYPE_CHOICES[option]
+            fields[name] = row[option] or None
             if row[option]:
-                name = "option%s" % TYPE_CHOICES[option]
-                setattr(variation, name, row[option])
-                new_option, created = ProductOption.objects.get_or_create(
-                    type=TYPE_CHOICES[option],  # TODO: set dynamically
-                    name=row[option])
-        variation.save()
-        image = _make_image(row[IMAGE], product)
-        if image:
-            variation.image = image
-        product.variations.manage_empty()
-        product.variations.set_default_images([])
-        product.copy_default_variation()
-        product.save()
+                # TODO: set dynamically
+                option = (TYPE_CHOICES[option], row[option])
+                if option not in self.options:
+                    self.options.add(option)
+                    self.new_options.add(option)
+        return fields
+
+    def manage_variations(self, product_ids):
+        """
+        For all of the given products at once, removes any redundant
+        empty variations, ensures there's a default variation, assigns
+        the first image to variations without one, and copies the
+        default variation's fields to the product.
+        """
+        variations = ProductVariation.objects.filter(
+            product_id__in=product_ids)
+        counts = variations.values("product_id").annotate(
+            count=Count("id")).filter(count__gt=1)
+        variations.filter(
+            product_id__in=[c["product_id"] for c in counts],
+            **ProductVariation.objects._empty_options_lookup()).delete()
+        with_default = variations.filter(default=True).values_list(
+            "product_id", flat=True)
+        first_ids = variations.exclude(product_id__in=list(with_default))
+        first_ids = first_ids.values("product_id").annotate(first=Min("id"))
+        variations.filter(id__in=[v["first"] for v in first_ids]).update(
+            default=True)
+        images = ProductImage.objects.filter(product_id__in=product_ids)
+        images = dict(images.values_list("product_id").annotate(Min("id")))
+        without_image = variations.filter(image__isnull=True,
+                                          product_id__in=list(images))
+        case_update(ProductVariation.objects.all(), dict([
+            (id, {"image": images[product_id]})
+            for id, product_id in without_image.values_list("id",
+                                                            "product_id")]))
+        names = [f.name for f in Priced._meta.fields
+                 if not isinstance(f, AutoField)]
+        product_fields = {}
+        for fields in variations.filter(default=True).values(
+                "product_id", "image__file", *names):
+            product_id = fields.pop("product_id")
+            image = fields.pop("image__file")
+            if image:
+                fields["image"] = image
+            product_fields[product_id] = fields
+        case_update(Product.objects.all(), product_fields)
+
+    def unpublish_missing(self):
+        """
+        Sets published products that none of the imported rows
+        belong to as drafts. The import hashes of their variations are
+        cleared, so that their rows aren't skipped as unchanged when
+        they return to the feed, and they're published again.
+        """
+        published = Product.objects.filter(status=CONTENT_STATUS_PUBLISHED)
+        missing = list(set(published.values_list("id", flat=True)) -
+                       self.feed_products)
+        for i in range(0, len(missing), self.batch_size):
+            product_ids = missing[i:i + self.batch_size]
+            Product.objects.filter(id__in=product_ids).update(
+                status=CONTENT_STATUS_DRAFT)
+            ProductVariation.objects.filter(product_id__in=product_ids
+                                            ).update(import_hash="")
+        self.unpublished = len(missing)
 
+
+def import_products(csv_file, batch_size=250, upsert=False,
+                    unpublish_missing=False):
+    print(_("Importing .."))
+    # More appropriate for testing.
+    # Product.objects.all().delete()
+    importer = ProductImporter(batch_size, upsert)
+    importer.run(_read_rows(csv_file), unpublish_missing)
     print("Variations: %s" % ProductVariation.objects.all().count())
     print("Products: %s" % Product.objects.all().count())
 
 
-def export_products(csv_file):
-    print(_("Exporting .."))
-    filehandle = open(csv_file, 'w')
-    writer = csv.DictWriter(filehandle, delimiter=',', fieldnames=fieldnames)
-    headers = dict()
-    for field in fieldnames:
-        headers[field] = field
-    writer.writerow(headers)
-    for pv in ProductVariation.objects.all():
-        row = dict()
-        row[TITLE] = pv.product.title
-        row[CONTENT] = pv.product.content
-        row[DESCRIPTION] = pv.product.description
-        row[SKU] = pv.sku
-        row[IMAGE] = pv.image
-        # TODO: handle multiple categories, and multiple levels of categories
-        cat = pv.product.categories.all()[0]
+def _export_variations(chunk_size):
+    """
+    Yields every variation ordered by ID, loading them in chunks of the
+    given size, each with a query for the variations along with their
+    products and images, and one for their products' categories.
+    """
+    categories = Category.objects.select_related("parent")
+    variations = ProductVariation.objects.select_related(
+        "product", "image").prefetch_related(
+        Prefetch("product__categories", queryset=categories)).order_by("id")
+    last_id = 0
+    while True:
+        chunk = list(variations.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        for pv in chunk:
+            yield pv
+        last_id = chunk[-1].id
+
+
+def _export_row(pv):
+    """
+    Returns a dict of the export columns for the variation.
+    """
+    row = dict.fromkeys(fieldnames, "")
+    row[TITLE] = pv.product.title
+    row[CONTENT] = pv.product.content
+    row[DESCRIPTION] = pv.product.description
+    row[SKU] = pv.sku
+    row[IMAGE] = force_text(pv.image) if pv.image else ""
+    # TODO: handle multiple categories, and multiple levels of categories
+    categories = pv.product.categories.all()
+    if categories:
+        cat = categories[0]
         if cat.parent:
             row[SUB_CATEGORY] = cat.title
             row[CATEGORY] = cat.parent.title
         else:
             row[CATEGORY] = cat.title
-            row[SUB_CATEGORY] = ""
 
-        for option in TYPE_CHOICES:
-            row[option] = getattr(pv, "option%s" % TYPE_CHOICES[option])
+    for option in TYPE_CHOICES:
+        row[option] = getattr(pv, "option%s" % TYPE_CHOICES[option])
 
-        row[NUM_IN_STOCK] = pv.num_in_stock
-        row[UNIT_PRICE] = pv.unit_price
-        row[SALE_PRICE] = pv.sale_price
-        try:
-            row[SALE_START_DATE] = pv.sale_from.strftime(DATE_FORMAT)
-            row[SALE_START_TIME] = pv.sale_from.strftime(TIME_FORMAT)
-        except AttributeError:
-            pass
-        try:
-            row[SALE_END_DATE] = pv.sale_to.strftime(DATE_FORMAT)
-            row[SALE_END_TIME] = pv.sale_to.strftime(TIME_FORMAT)
-        except AttributeError:
-            pass
-        writer.writerow(row)
-    filehandle.close()
+    row[NUM_IN_STOCK] = pv.num_in_stock
+    row[UNIT_PRICE] = pv.unit_price
+    row[SALE_PRICE] = pv.sale_price
+    if pv.sale_from:
+        row[SALE_START_DATE] = pv.sale_from.strftime(DATE_FORMAT)
+        row[SALE_START_TIME] = pv.sale_from.strftime(TIME_FORMAT)
+    if pv.sale_to:
+        row[SALE_END_DATE] = pv.sale_to.strftime(DATE_FORMAT)
+        row[SALE_END_TIME] = pv.sale_to.strftime(TIME_FORMAT)
+    return row
+
+
+def export_products(csv_file, format="csv", chunk_size=250):
+    print(_("Exporting .."))
+    with _open(csv_file, "w") as f:
+        if format == "csv":
+            writer = csv.DictWriter(f, delimiter=',', fieldnames=fieldnames)
+            writer.writeheader()
+        for pv in _export_variations(chunk_size):
+            row = _export_row(pv)
+            if format == "ndjson":
+                row = dict([(force_text(k), v) for k, v in row.items()])
+                line = json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+                f.write(force_bytes(line) if PY2 else line)
+            elif PY2:
+                writer.writerow(dict([(k, force_bytes(v))
+                                      for k, v in row.items()
+                                      if v is not None]))
+            else:
+                writer.writerow(row)
@@ -0,0 +1,14 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.models import ProductAction
+
+
+class Command(BaseCommand):
+    help = _("Recalculate the popularity of every product from its "
+             "recorded adds to cart and purchases.")
+
+    def handle(self, *args, **options):
+        ProductAction.objects.rebuild_popularity()
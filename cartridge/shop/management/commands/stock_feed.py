@@ -0,0 +1,85 @@
+from __future__ import division, unicode_literals
+
+from decimal import Decimal
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.management.commands.product_db import (
+    NUM_IN_STOCK, SALE_END_DATE, SALE_END_TIME, SALE_PRICE, SALE_START_DATE,
+    SALE_START_TIME, SKU, UNIT_PRICE, _make_date, _read_rows)
+from cartridge.shop.models import ProductVariation
+
+
+class Command(BaseCommand):
+    args = '<csv_file>'
+    help = _("Update the stock levels and prices of variations from a csv "
+             "file of SKUs, using the product_db column headings. Only "
+             "the columns present are updated, with a blank value "
+             "clearing the field.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=300,
+            help=_('Number of rows to update in each transaction.')),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            csv_file = args[0]
+        except IndexError:
+            raise CommandError(_("Please provide csv file to import"))
+        self.verbosity = int(options.get("verbosity", 1))
+        start = time()
+        total = matched = 0
+        batch = {}
+        for row in _read_rows(csv_file):
+            if SKU not in row:
+                raise CommandError(_("No %s column") % SKU)
+            # strip whitespace
+            batch[row[SKU].replace(" ", "")] = self.fields_from_row(row)
+            if len(batch) == options["batch_size"]:
+                matched += ProductVariation.objects.update_priced(batch)
+                total += len(batch)
+                if self.verbosity > 1:
+                    self.report(total, matched, start)
+                batch = {}
+        if batch:
+            matched += ProductVariation.objects.update_priced(batch)
+            total += len(batch)
+        if self.verbosity > 0:
+            self.report(total, matched, start)
+
+    def fields_from_row(self, row):
+        """
+        Returns a dict of the variation fields for the columns in the
+        row, with blank columns as ``None``.
+        """
+        fields = {}
+        if NUM_IN_STOCK in row:
+            fields["num_in_stock"] = None
+            if row[NUM_IN_STOCK]:
+                fields["num_in_stock"] = int(row[NUM_IN_STOCK])
+        for name, column in (("unit_price", UNIT_PRICE),
+                             ("sale_price", SALE_PRICE)):
+            if column in row:
+                fields[name] = Decimal(row[column]) if row[column] else None
+        for name, date_column, time_column in (
+                ("sale_from", SALE_START_DATE, SALE_START_TIME),
+                ("sale_to", SALE_END_DATE, SALE_END_TIME)):
+            if date_column in row:
+                fields[name] = None
+                if row[date_column]:
+                    fields[name] = _make_date(row[date_column],
+                                              row.get(time_column) or "00:00")
+        return fields
+
+    def report(self, total, matched, start):
+        elapsed = time() - start
+        rate = total / elapsed if elapsed else total
+        self.stdout.write(_("Updated %s of %s SKUs (%.0f rows per second)") %
+                          (matched, total, rate))
@@ -2,16 +2,157 @@ from __future__ import unicode_literals
 from future.builtins import str, zip
 
 from collections import defaultdict, OrderedDict
-from datetime import datetime, timedelta
-
-from django.db.models import Manager, Q
+from datetime import date, datetime, timedelta
+from functools import reduce
+from logging import getLogger
+from math import log, log1p
+from operator import ior
+from time import time
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, FloatField, IntegerField, Manager
+from django.db.models import Count, Q, Sum
+from django.db.models import Value, When
+from django.db.models.query import QuerySet
 from django.utils.timezone import now
 
 from mezzanine.conf import settings
-from mezzanine.core.managers import CurrentSiteManager
+from mezzanine.core.managers import CurrentSiteManager, DisplayableManager
+
+from cartridge.shop import actions, caching
+from cartridge.shop.utils import case_update
+
+
+logger = getLogger(__name__)
+
+
+# Ordinal day from which popularity scores grow, see popularity_score.
+POPULARITY_EPOCH = date(2017, 1, 1).toordinal()
+
+# Number of times adding to popularity is attempted when concurrent
+# updates change it, see ProductActionManager._add_popularity.
+POPULARITY_ATTEMPTS = 3
+
+
+# Bits of ``Product.category_flags``, see category_flags.
+CATEGORY_FLAG_MAGAZINE = 1
+CATEGORY_FLAG_ARTICLE = 2
+CATEGORY_FLAG_SUBSCRIPTION = 4
+CATEGORY_FLAG_FREE = 8
+CATEGORY_FLAG_PRINT = 16
+
+
+def category_flags(title, keywords_string):
+    """
+    Returns the ``Product.category_flags`` bits for a product in a
+    category with the given title and keywords.
+    """
+    flags = 0
+    titles = {"Magazine": CATEGORY_FLAG_MAGAZINE,
+              "Article": CATEGORY_FLAG_ARTICLE,
+              "Subscription": CATEGORY_FLAG_SUBSCRIPTION,
+              "Free": CATEGORY_FLAG_FREE}
+    flags |= titles.get(title, 0)
+    if "print" in (keywords_string or ""):
+        flags |= CATEGORY_FLAG_PRINT
+    return flags
+
+
+class ProductManager(DisplayableManager):
+
+    def update_category_flags(self, product_ids=None):
+        """
+        Recalculates the denormalised ``category_flags`` of the
+        products with the given IDs, or all products, reading their
+        categories in a single query and performing one update for
+        each distinct combination of flags.
+        """
+        if product_ids is None:
+            product_ids = self.values_list("id", flat=True)
+        flags = dict([(product_id, 0) for product_id in product_ids])
+        if not flags:
+            return
+        through = self.model.categories.through
+        categories = through.objects.filter(product_id__in=list(flags))
+        for product_id, title, keywords in categories.values_list(
+                "product_id", "category__title", "category__keywords_string"):
+            flags[product_id] |= category_flags(title, keywords)
+        product_ids_by_flags = defaultdict(list)
+        for product_id, product_flags in flags.items():
+            product_ids_by_flags[product_flags].append(product_id)
+        for product_flags, product_ids in product_ids_by_flags.items():
+            self.filter(id__in=product_ids).update(
+                category_flags=product_flags)
+
+    def prefetch_required_permissions(self, products):
+        """
+        Stores the codenames of the required permissions of each of
+        the given products on them, reading them from the cache where
+        possible, and otherwise with a single query.
+        """
+        products = [product for product in products
+                    if not hasattr(product, "_required_codenames")]
+        if not products:
+            return
 
+        def load(product_ids):
+            codenames = dict([(product_id, []) for product_id in product_ids])
+            through = self.model.required_permissions.through
+            permissions = through.objects.filter(product_id__in=product_ids)
+            for product_id, codename in permissions.values_list(
+                    "product_id", "permission__codename"):
+                codenames[product_id].append(codename)
+            return codenames
 
-class CartManager(Manager):
+        product_ids = [product.id for product in products]
+        codenames = caching.product_values("permissions", product_ids, load)
+        for product in products:
+            product._required_codenames = codenames[product.id]
+
+    def perm_check_many(self, user, products):
+        """
+        Returns a dict mapping the ID of each of the given products to
+        the result of its ``perm_check`` for the given user, loading
+        all of their required permissions at once.
+        """
+        products = list(products)
+        self.prefetch_required_permissions(products)
+        return dict([(product.id, product.perm_check(user))
+                     for product in products])
+
+
+class CartQuerySet(QuerySet):
+
+    def item_quantities(self, skus=None):
+        """
+        Return a dict of SKUs mapped to the total quantity of each
+        held across the items in the carts, optionally only for the
+        given SKUs.
+        """
+        from cartridge.shop.models import CartItem
+        items = CartItem.objects.filter(cart__in=self)
+        if skus is not None:
+            items = items.filter(sku__in=list(skus))
+        items = items.values("sku")
+        items = items.annotate(quantity_sum=Sum("quantity")).order_by()
+        return dict([(i["sku"], i["quantity_sum"]) for i in items])
+
+    def delete(self):
+        """
+        Release the stock reserved by the carts' items, and any
+        discount code uses reserved by the carts, before deleting
+        them, since their items are removed via a cascading delete
+        that bypasses ``CartItem.delete``.
+        """
+        from cartridge.shop.models import DiscountReservation
+        from cartridge.shop.models import StockReservation
+        with transaction.atomic():
+            StockReservation.objects.release(self.item_quantities())
+            DiscountReservation.objects.filter(cart__in=self).release()
+            return super(CartQuerySet, self).delete()
+
+
+class CartManager(Manager.from_queryset(CartQuerySet)):
 
     def from_request(self, request):
         """
@@ -23,13 +164,29 @@ class CartManager(Manager):
         cart = self.current().filter(id=cart_id)
         last_updated = now()
 
+        # With SHOP_CART_HEARTBEAT_FRACTION set, skip updating the
+        # timestamp if the session shows it was recently updated.
+        # The cart may have since been deleted, so it's flagged for
+        # ``Cart.add_item`` to save it before adding to it.
+        heartbeat = (settings.SHOP_CART_EXPIRY_MINUTES * 60 *
+                     settings.SHOP_CART_HEARTBEAT_FRACTION)
+        touched = request.session.get("cart_touched", 0)
+        if cart_id and heartbeat and time() - touched < heartbeat:
+            cart = self.model(id=cart_id, last_updated=last_updated)
+            cart.unconfirmed = True
+            return cart
+
         # Update timestamp and clear out old carts.
         if cart_id and cart.update(last_updated=last_updated):
-            self.expired().delete()
+            if settings.SHOP_CART_EXPIRE_INLINE:
+                self.expired().delete()
+            if heartbeat:
+                request.session["cart_touched"] = time()
         elif cart_id:
             # Cart has expired. Delete the cart id and
             # forget what checkout step we were up to.
             del request.session["cart"]
+            request.session.pop("cart_touched", None)
             cart_id = None
             try:
                 del request.session["order"]["step"]
@@ -41,6 +198,23 @@ class CartManager(Manager):
         # a cart instance without taking a trip to the database via the ORM.
         return self.model(id=cart_id, last_updated=last_updated)
 
+    def delete_expired(self, batch_size=1000):
+        """
+        Deletes expired carts in batches of the given size, each
+        bounded by a primary key range and in its own transaction,
+        yielding the number of carts in each batch.
+        """
+        expired = self.expired()
+        last_id = 0
+        while True:
+            ids = list(expired.filter(id__gt=last_id).order_by("id")
+                       .values_list("id", flat=True)[:batch_size])
+            if not ids:
+                return
+            expired.filter(id__gte=ids[0], id__lte=ids[-1]).delete()
+            last_id = ids[-1]
+            yield len(ids)
+
     def expiry_time(self):
         """
         Datetime for expired carts.
@@ -60,6 +234,53 @@ class CartManager(Manager):
         return self.filter(last_updated__lt=self.expiry_time())
 
 
+class StockReservationManager(Manager):
+
+    def reserve(self, sku, quantity):
+        """
+        Adjust the quantity held in carts for the given SKU, creating
+        its ledger row the first time the SKU is added to a cart.
+        """
+        if not quantity:
+            return
+        reserved = self.filter(sku=sku)
+        if reserved.update(quantity=F("quantity") + quantity):
+            return
+        try:
+            with transaction.atomic():
+                self.create(sku=sku, quantity=quantity)
+        except IntegrityError:
+            # Row was created by a concurrent request since the
+            # update above was attempted.
+            reserved.update(quantity=F("quantity") + quantity)
+
+    def release(self, quantities):
+        """
+        Release the quantities held for each SKU in the given dict of
+        SKUs and quantities, as cart items are removed.
+        """
+        for sku, quantity in quantities.items():
+            if quantity:
+                self.filter(sku=sku).update(quantity=F("quantity") - quantity)
+
+    def reserved(self, skus):
+        """
+        Return a dict of the given SKUs mapped to the quantity of each
+        currently held in carts, with a query for the ledger, and one
+        for the items in carts that have expired but aren't deleted
+        yet, which no longer hold their items.
+        """
+        from cartridge.shop.models import Cart
+        reserved = dict([(sku, 0) for sku in skus])
+        if reserved:
+            ledger = self.filter(sku__in=list(reserved))
+            reserved.update(ledger.values_list("sku", "quantity"))
+            expired = Cart.objects.expired().item_quantities(reserved)
+            for sku, quantity in expired.items():
+                reserved[sku] = max(reserved[sku] - quantity, 0)
+        return reserved
+
+
 class OrderManager(CurrentSiteManager):
 
     def from_request(self, request):
@@ -112,6 +333,137 @@ class ProductVariationManager(Manager):
         return dict([("%s__isnull" % f.name, True)
             for f in self.model.option_fields() if f.name not in exclude])
 
+    def live_stock(self, variations):
+        """
+        Load the live number in stock for each of the given variations
+        with a single query against the stock reservation ledger,
+        caching the value on each variation for subsequent calls to
+        ``live_num_in_stock`` and ``has_stock``. Returns a dict of
+        SKUs mapped to their live number in stock.
+        """
+        from cartridge.shop.models import StockReservation
+        variations = [v for v in variations if v.num_in_stock is not None]
+        skus = [v.sku for v in variations]
+        reserved = StockReservation.objects.reserved(skus)
+        for variation in variations:
+            variation._cached_num_in_stock = (variation.num_in_stock -
+                                              reserved[variation.sku])
+        return dict([(v.sku, v._cached_num_in_stock) for v in variations])
+
+    def remove_stock(self, quantities):
+        """
+        Reduce the stock level of each SKU in the given dict of SKUs
+        and quantities, for variations with stock control enabled.
+        Each update is guarded so that it only applies while at least
+        the quantity is in stock, and SKUs are grouped by quantity so
+        that a single ``F()`` expression update is performed for each
+        distinct quantity, rather than loading and saving each
+        variation. Returns the list of SKUs without enough stock, in
+        which case no stock is removed at all.
+        """
+        controlled = self.filter(sku__in=list(quantities),
+                                 num_in_stock__isnull=False)
+        counts = defaultdict(int)
+        for sku in controlled.values_list("sku", flat=True):
+            counts[sku] += 1
+        skus_by_quantity = defaultdict(list)
+        for sku, quantity in quantities.items():
+            if quantity and sku in counts:
+                skus_by_quantity[quantity].append(sku)
+        with transaction.atomic():
+            for quantity, skus in skus_by_quantity.items():
+                in_stock = controlled.filter(sku__in=skus,
+                                             num_in_stock__gte=quantity)
+                updated = in_stock.update(
+                    num_in_stock=F("num_in_stock") - quantity)
+                if updated < sum([counts[sku] for sku in skus]):
+                    # Read which SKUs were short before undoing the
+                    # updates already performed, since stock may be
+                    # added once they're undone.
+                    short = controlled.filter(sku__in=skus,
+                                              num_in_stock__lt=quantity)
+                    failed = set(short.values_list("sku", flat=True))
+                    transaction.set_rollback(True)
+                    return sorted(failed or skus)
+            self.update_product_stock(list(quantities))
+        return []
+
+    def add_stock(self, quantities):
+        """
+        Increase the stock level of each SKU in the given dict of SKUs
+        and quantities, for variations with stock control enabled,
+        such as when stock removed for an order is restored after its
+        payment fails. Negative quantities reduce the stock level
+        without the guard applied by ``remove_stock``.
+        """
+        skus_by_quantity = defaultdict(list)
+        for sku, quantity in quantities.items():
+            if quantity:
+                skus_by_quantity[quantity].append(sku)
+        with transaction.atomic():
+            for quantity, skus in skus_by_quantity.items():
+                self.filter(sku__in=skus, num_in_stock__isnull=False).update(
+                    num_in_stock=F("num_in_stock") + quantity)
+            self.update_product_stock(list(quantities))
+
+    def update_product_stock(self, skus):
+        """
+        Copy the stock level of any default variations for the given
+        SKUs to the denormalised stock level of their products, with
+        a single update for all of the products.
+        """
+        from cartridge.shop.models import Product
+        defaults = self.filter(sku__in=skus, default=True)
+        stock = dict(defaults.values_list("product_id", "num_in_stock"))
+        if stock:
+            num_in_stock = Case(*[When(id=product_id, then=Value(num))
+                                  for product_id, num in stock.items()],
+                                output_field=IntegerField())
+            products = Product.objects.filter(id__in=list(stock))
+            products.update(num_in_stock=num_in_stock)
+
+    def update_priced(self, values):
+        """
+        Given a dict mapping SKUs to dicts of ``Priced`` field values,
+        such as from a stock and price feed, updates the variations
+        with a ``CASE`` update for each field, and the denormalised
+        fields of the products of any default variations, in a single
+        transaction. Since no signals are sent, cached product pages
+        are invalidated and the products' category membership is
+        updated here. Returns the number of variations matched.
+        """
+        from cartridge.shop.models import Product
+        from cartridge.shop.models import update_variation_memberships
+        filter_fields = set(["sale_id", "sale_price", "sale_from",
+                             "sale_to", "unit_price"])
+        names = set([name for fields in values.values() for name in fields])
+        with transaction.atomic():
+            matched = case_update(self.all(), values, key="sku")
+            defaults = self.filter(sku__in=list(values), default=True)
+            case_update(Product.objects.all(), dict([
+                (product_id, values[sku])
+                for product_id, sku in defaults.values_list("product_id",
+                                                            "sku")]))
+            if matched and names & filter_fields:
+                update_variation_memberships(self.filter(
+                    sku__in=list(values)).values_list("product_id",
+                                                      flat=True))
+        if matched:
+            caching.invalidate_products()
+        return matched
+
+    def without_stock(self, quantities):
+        """
+        Given a dict of SKUs and quantities, return the list of SKUs
+        that don't have the given quantity in stock, checking all of
+        them with one query for the variations and one for the
+        stock reservation ledger.
+        """
+        variations = list(self.filter(sku__in=list(quantities)))
+        self.live_stock(variations)
+        return [v.sku for v in variations
+                if not v.has_stock(quantities[v.sku])]
+
     def create_from_options(self, options):
         """
         Create all unique variations from the selected options.
@@ -176,20 +528,164 @@ class ProductVariationManager(Manager):
                 variation.save()
 
 
+def popularity_score(field, amount, timestamp):
+    """
+    Returns the popularity score for the given amount of the given
+    ``ProductAction`` field, recorded on the given ordinal day, or
+    ``None`` if it doesn't count towards popularity. Rather than
+    decaying every stored score over time, scores for newer actions
+    grow exponentially, doubling every ``SHOP_POPULARITY_HALF_LIFE``
+    days after ``POPULARITY_EPOCH``, which ranks the sum of a
+    product's scores identically. Since these grow without bound,
+    scores are base 2 logarithms, summed with ``add_popularity``.
+    """
+    weight = settings.SHOP_POPULARITY_WEIGHTS.get(field, 0)
+    if not amount or not weight:
+        return None
+    days = timestamp - POPULARITY_EPOCH
+    return (log(amount * weight, 2) +
+            days / float(settings.SHOP_POPULARITY_HALF_LIFE))
+
+
+def add_popularity(popularity, score):
+    """
+    Returns the sum of the given popularity and score, which are both
+    base 2 logarithms, without leaving log space. A popularity of
+    zero, the default, counts as a single action on
+    ``POPULARITY_EPOCH``, which is negligible next to newer actions.
+    """
+    high, low = max(popularity, score), min(popularity, score)
+    return high + log1p(2 ** (low - high)) / log(2)
+
+
 class ProductActionManager(Manager):
 
     use_for_related_fields = True
 
     def _action_for_field(self, field):
         """
-        Increases the given field by datetime.today().toordinal()
-        which provides a time scaling value we can order by to
-        determine popularity over time.
+        Increases the given field for the current product and
+        datetime.today().toordinal() which provides a time scaling
+        value we can order by to determine popularity over time.
+        """
+        self.record(field, {self.instance.id: 1})
+
+    def record(self, field, amounts):
+        """
+        Increase the given field by the amount for each product ID in
+        the given dict of product IDs and amounts for today, either
+        immediately or via the write-behind buffer when the
+        ``SHOP_PRODUCT_ACTION_BUFFER`` setting is enabled.
         """
         timestamp = datetime.today().toordinal()
-        action, created = self.get_or_create(timestamp=timestamp)
-        setattr(action, field, getattr(action, field) + 1)
-        action.save()
+        if settings.SHOP_PRODUCT_ACTION_BUFFER:
+            actions.buffer(field, amounts, timestamp)
+        else:
+            self.increment(field, amounts, timestamp)
+
+    def increment(self, field, amounts, timestamp=None):
+        """
+        Increase the given field by the amount for each product ID in
+        the given dict of product IDs and amounts, for the given
+        ordinal day (defaulting to today). Existing rows are updated
+        with a single ``F()`` expression update, and missing rows are
+        created with a single bulk insert.
+        """
+        if timestamp is None:
+            timestamp = datetime.today().toordinal()
+        amounts = dict([(k, v) for k, v in amounts.items() if v])
+        if not amounts:
+            return
+        actions = self.filter(timestamp=timestamp,
+                              product_id__in=list(amounts))
+        existing = set(actions.values_list("product_id", flat=True))
+        if existing:
+            amount = Case(*[When(product_id=product_id,
+                                 then=Value(amounts[product_id]))
+                            for product_id in existing],
+                          output_field=IntegerField())
+            actions.update(**{field: F(field) + amount})
+        missing = [product_id for product_id in amounts
+                   if product_id not in existing]
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create([self.model(product_id=product_id,
+                        timestamp=timestamp, **{field: amounts[product_id]})
+                        for product_id in missing])
+            except IntegrityError:
+                # Rows were created by a concurrent request since
+                # checking for existing rows, so fall back to one at
+                # a time.
+                for product_id in missing:
+                    lookup = {"product_id": product_id,
+                              "timestamp": timestamp}
+                    action, created = self.get_or_create(**lookup)
+                    self.filter(id=action.id).update(
+                        **{field: F(field) + amounts[product_id]})
+        scores = dict([(product_id, popularity_score(field, num, timestamp))
+                       for product_id, num in amounts.items()])
+        self._add_popularity(scores)
+
+    def _add_popularity(self, scores):
+        """
+        Adds the given dict of product IDs and popularity scores to
+        each product's denormalised popularity. Summing logarithms
+        can't be expressed portably in SQL, so rather than locking the
+        products, their popularity is read and then set by a single
+        update that only applies if none of them have changed since.
+        This is retried if a concurrent update changed any of them,
+        and after ``POPULARITY_ATTEMPTS`` the scores are left for
+        ``rebuild_popularity`` to add, since they're still recorded
+        by the product's actions.
+        """
+        from cartridge.shop.models import Product
+        scores = dict([(k, v) for k, v in scores.items() if v is not None])
+        products = Product.objects.filter(id__in=list(scores))
+        for attempt in range(POPULARITY_ATTEMPTS):
+            popularity = dict(products.values_list("id", "popularity"))
+            if not popularity:
+                return
+            unchanged = reduce(ior, [Q(id=product_id, popularity=value)
+                                     for product_id, value
+                                     in popularity.items()])
+            total = Case(*[When(id=product_id, then=Value(
+                               add_popularity(value, scores[product_id])))
+                           for product_id, value in popularity.items()],
+                         output_field=FloatField())
+            with transaction.atomic():
+                if (products.filter(unchanged).update(popularity=total) ==
+                        len(popularity)):
+                    return
+                transaction.set_rollback(True)
+        logger.warning("Popularity of products %s not updated due to "
+                       "concurrent updates", ", ".join(map(str, popularity)))
+
+    def rebuild_popularity(self, chunk_size=300):
+        """
+        Recalculates the denormalised popularity of every product from
+        all of its recorded actions. Only required when the popularity
+        settings change, since ``increment`` keeps popularity up to
+        date as actions are recorded.
+        """
+        from cartridge.shop.models import Product
+        scores = defaultdict(float)
+        fields = ("product_id", "timestamp", "total_cart", "total_purchase")
+        for product_id, timestamp, total_cart, total_purchase in (
+                self.values_list(*fields).iterator()):
+            for field, amount in (("total_cart", total_cart),
+                                  ("total_purchase", total_purchase)):
+                score = popularity_score(field, amount, timestamp)
+                if score is not None:
+                    scores[product_id] = add_popularity(scores[product_id],
+                                                        score)
+        scores = [(product_id, {"popularity": total})
+                  for product_id, total in scores.items()]
+        with transaction.atomic():
+            Product.objects.update(popularity=0)
+            for i in range(0, len(scores), chunk_size):
+                case_update(Product.objects.all(),
+                            dict(scores[i:i + chunk_size]))
 
     def added_to_cart(self):
         """
@@ -206,27 +702,122 @@ class ProductActionManager(Manager):
 
 class DiscountCodeManager(Manager):
 
-    def active(self, *args, **kwargs):
+    def current(self):
         """
         Items flagged as active and in valid date range if date(s) are
-        specified.
+        specified, regardless of their uses remaining.
         """
         n = now()
         valid_from = Q(valid_from__isnull=True) | Q(valid_from__lte=n)
         valid_to = Q(valid_to__isnull=True) | Q(valid_to__gte=n)
-        valid = self.filter(valid_from, valid_to, active=True)
-        return valid.exclude(uses_remaining=0)
+        return self.filter(valid_from, valid_to, active=True)
+
+    def active(self, *args, **kwargs):
+        """
+        Items flagged as active and in valid date range if date(s) are
+        specified.
+        """
+        return self.current().exclude(uses_remaining=0)
 
     def get_valid(self, code, cart):
         """
         Items flagged as active and within date range as well checking
         that the given cart contains items that the code is valid for.
+        A use of the code reserved for the cart counts as remaining.
         """
         total_price_valid = (Q(min_purchase__isnull=True) |
                              Q(min_purchase__lte=cart.total_price()))
-        discount = self.active().get(total_price_valid, code=code)
-        products = discount.all_products()
-        if products.count() > 0:
-            if products.filter(variations__sku__in=cart.skus()).count() == 0:
-                raise self.model.DoesNotExist
+        discounts = self.active()
+        if cart.pk:
+            remaining = (~Q(uses_remaining=0) |
+                         Q(reservations__cart_id=cart.pk))
+            discounts = self.current().filter(remaining).distinct()
+        discount = discounts.get(total_price_valid, code=code)
+        skus = discount.applicable_skus()
+        if skus is not None and not skus & set(cart.skus()):
+            raise self.model.DoesNotExist
         return discount
+
+
+class DiscountReservationQuerySet(QuerySet):
+
+    def release(self):
+        """
+        Return the reserved uses to their discount codes and delete
+        the reservations, when their carts are deleted or payment
+        fails.
+        """
+        from cartridge.shop.models import DiscountCode
+        counts = self.values("discount_id").annotate(count=Count("id"))
+        with transaction.atomic():
+            for count in counts.order_by():
+                discount = DiscountCode.objects.filter(
+                    id=count["discount_id"], uses_remaining__isnull=False)
+                discount.update(
+                    uses_remaining=F("uses_remaining") + count["count"])
+            self.delete()
+
+
+class DiscountReservationManager(
+        Manager.from_queryset(DiscountReservationQuerySet)):
+
+    def reserve(self, code, cart):
+        """
+        Reserve a use of the given discount code for the cart, when
+        the code is applied and again before payment, releasing any
+        use reserved by the cart for a different code. The code's
+        uses remaining are decremented by a single conditional update,
+        so that concurrent checkouts can't use it more times than
+        remain. Returns ``False`` if no uses remain. Codes without a
+        limit on their uses, and carts not yet saved, aren't reserved.
+        If a concurrent request reserves a use for the same cart, the
+        use decremented here is returned to the code.
+        """
+        from cartridge.shop.models import DiscountCode
+        if not cart.pk:
+            return True
+        reserved = self.filter(cart_id=cart.pk)
+        if reserved.filter(discount__code=code).exists():
+            return True
+        reserved.release()
+        discounts = DiscountCode.objects.filter(code=code)
+        if not discounts.filter(uses_remaining__isnull=False).exists():
+            return True
+        with transaction.atomic():
+            if not discounts.filter(uses_remaining__gt=0).update(
+                    uses_remaining=F("uses_remaining") - 1):
+                return False
+            try:
+                with transaction.atomic():
+                    self.create(discount=discounts.get(), cart_id=cart.pk)
+            except IntegrityError:
+                # A use was reserved for the cart by a concurrent
+                # request since checking above, so the decrement is
+                # rolled back and the cart keeps that reservation.
+                reserved_code = reserved.filter(discount__code=code).exists()
+                transaction.set_rollback(True)
+                return reserved_code
+        return True
+
+    def redeem(self, code, cart):
+        """
+        Commit the use of the given discount code reserved for the
+        cart when its order is complete, or use it with a conditional
+        update if it wasn't reserved. Returns ``False`` if the code
+        has no uses remaining to redeem, in which case the order has
+        used the code more times than it allows, and it's logged.
+        """
+        from cartridge.shop.models import DiscountCode
+        reserved = self.filter(cart_id=cart.pk, discount__code=code)
+        if cart.pk and reserved.exists():
+            reserved.delete()
+            return True
+        discounts = DiscountCode.objects.filter(code=code)
+        if discounts.filter(uses_remaining__gt=0).update(
+                uses_remaining=F("uses_remaining") - 1):
+            return True
+        if discounts.filter(uses_remaining__isnull=False).exists():
+            logger.warning("Discount code %s redeemed with no uses "
+                           "remaining, for cart %s", code, cart.pk)
+            return False
+        return True
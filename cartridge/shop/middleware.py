@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
+from django.utils.functional import SimpleLazyObject
+from django.utils.timezone import now
 from mezzanine.conf import settings
 
+from cartridge.shop.carts import cart_from_request
 from cartridge.shop.models import Cart
 
 
@@ -26,10 +29,20 @@ class SSLRedirect(object):
 
 class ShopMiddleware(SSLRedirect):
     """
-    Adds cart and wishlist attributes to the current request.
+    Adds cart and wishlist attributes to the current request. The
+    cart is only retrieved from the database when it's first used,
+    and not at all for URLs starting with any of the prefixes in the
+    ``SHOP_CART_SKIP_URL_PREFIXES`` setting. Anonymous shoppers may
+    get a cart kept in the session or cache, according to the
+    ``SHOP_CART_STORAGE`` setting.
     """
     def process_request(self, request):
-        request.cart = Cart.objects.from_request(request)
+        skip_prefixes = tuple(settings.SHOP_CART_SKIP_URL_PREFIXES)
+        if request.path.startswith(skip_prefixes):
+            request.cart = Cart(last_updated=now())
+        else:
+            request.cart = SimpleLazyObject(
+                lambda: cart_from_request(request))
         wishlist = request.COOKIES.get("wishlist", "").split(",")
         if not wishlist[0]:
             wishlist = []
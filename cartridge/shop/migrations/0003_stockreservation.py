@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Sum
+import cartridge.shop.fields
+
+
+def seed_stock_reservations(apps, schema_editor):
+    """
+    Populate the ledger from the items in existing carts.
+    """
+    CartItem = apps.get_model("shop", "CartItem")
+    StockReservation = apps.get_model("shop", "StockReservation")
+    items = CartItem.objects.values("sku").order_by()
+    items = items.annotate(quantity_sum=Sum("quantity"))
+    StockReservation.objects.bulk_create([
+        StockReservation(sku=item["sku"], quantity=item["quantity_sum"])
+        for item in items])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0002_auto_20170820_1845'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sku', cartridge.shop.fields.SKUField(unique=True, max_length=20, verbose_name='SKU')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Quantity')),
+            ],
+        ),
+        migrations.RunPython(seed_stock_reservations,
+                             migrations.RunPython.noop),
+    ]
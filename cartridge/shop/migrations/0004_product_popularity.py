@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import date
+from math import log, log1p
+
+from django.db import migrations, models
+from mezzanine.conf import settings
+
+
+def calculate_popularity(apps, schema_editor):
+    """
+    Populate product popularity from existing product actions, as the
+    base 2 logarithm of the sum of each action's score, which doubles
+    every ``SHOP_POPULARITY_HALF_LIFE`` days after the start of 2017.
+    """
+    Product = apps.get_model("shop", "Product")
+    ProductAction = apps.get_model("shop", "ProductAction")
+    epoch = date(2017, 1, 1).toordinal()
+    half_life = float(settings.SHOP_POPULARITY_HALF_LIFE)
+    scores = defaultdict(float)
+    for action in ProductAction.objects.iterator():
+        for field in ("total_cart", "total_purchase"):
+            amount = getattr(action, field)
+            weight = settings.SHOP_POPULARITY_WEIGHTS.get(field, 0)
+            if not amount or not weight:
+                continue
+            score = (log(amount * weight, 2) +
+                     (action.timestamp - epoch) / half_life)
+            high = max(scores[action.product_id], score)
+            low = min(scores[action.product_id], score)
+            scores[action.product_id] = (high +
+                                         log1p(2 ** (low - high)) / log(2))
+    for product_id, score in scores.items():
+        Product.objects.filter(id=product_id).update(popularity=score)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='popularity',
+            field=models.FloatField(default=0, verbose_name='Popularity', editable=False, db_index=True),
+        ),
+        migrations.RunPython(calculate_popularity,
+                             migrations.RunPython.noop),
+    ]
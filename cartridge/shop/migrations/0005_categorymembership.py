@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_product_popularity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryMembership',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('category', models.ForeignKey(related_name='memberships', to='shop.Category')),
+                ('product', models.ForeignKey(related_name='category_memberships', to='shop.Product')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='categorymembership',
+            unique_together=set([('category', 'product')]),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='membership_expiry',
+            field=models.DateTimeField(null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='membership_stale',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def calculate_category_flags(apps, schema_editor):
+    """
+    Populate the category flags of products from their categories,
+    with a bit for each of the titles below, and for categories with
+    "print" in their keywords.
+    """
+    Product = apps.get_model("shop", "Product")
+    titles = {"Magazine": 1, "Article": 2, "Subscription": 4, "Free": 8}
+    flags = defaultdict(int)
+    categories = Product.categories.through.objects.values_list(
+        "product_id", "category__title", "category__keywords_string")
+    for product_id, title, keywords in categories:
+        flags[product_id] |= titles.get(title, 0)
+        if "print" in (keywords or ""):
+            flags[product_id] |= 16
+    for product_id, product_flags in flags.items():
+        Product.objects.filter(id=product_id).update(
+            category_flags=product_flags)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_categorymembership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='category_flags',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(calculate_category_flags,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_product_category_flags'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscountReservation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('cart', models.OneToOneField(related_name='discount_reservation', to='shop.Cart')),
+                ('discount', models.ForeignKey(related_name='reservations', to='shop.DiscountCode')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_discountreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productvariation',
+            name='import_hash',
+            field=models.CharField(verbose_name='Import hash', max_length=32, blank=True, editable=False),
+        ),
+    ]
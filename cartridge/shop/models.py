@@ -1,17 +1,20 @@
 from __future__ import division, unicode_literals
 
+from collections import defaultdict
 from decimal import Decimal
 from functools import reduce
+from logging import getLogger
 from operator import iand, ior
 
-from cartridge.shop import fields, managers
-from cartridge.shop.utils import clear_session
+from cartridge.shop import caching, fields, managers
+from cartridge.shop.utils import cart_totals, clear_session
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models, connection
-from django.db.models import CharField, Q, F
+from django.db import IntegrityError, models, connection, transaction
+from django.db.models import CharField, Q, F, Min
 from django.db.models.base import ModelBase
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from django.utils.encoding import force_text
 from django.utils.encoding import python_2_unicode_compatible
@@ -22,7 +25,6 @@ from future.builtins import str, super
 from future.utils import with_metaclass
 from mezzanine.conf import settings
 from mezzanine.core.fields import FileField,RichTextField
-from mezzanine.core.managers import DisplayableManager
 from mezzanine.core.models import Displayable, RichText, Orderable, SiteRelated
 from mezzanine.generic.fields import RatingField
 from mezzanine.pages.models import Page
@@ -36,6 +38,10 @@ from __builtin__ import True
 
 from django.contrib.auth.models import Permission
 
+
+logger = getLogger(__name__)
+
+
 class Priced(models.Model):
     """
     Abstract model with unit and sale price fields. Inherited by
@@ -110,9 +116,12 @@ class Product( Priced, RichText, AdminThumbMixin,Displayable):
     upsell_products = models.ManyToManyField("self",
                              verbose_name=_("Upsell products"), blank=True)
     rating = RatingField(verbose_name=_("Rating"))
+    popularity = models.FloatField(_("Popularity"), default=0, db_index=True,
+                                   editable=False)
+    category_flags = models.IntegerField(default=0, editable=False)
     required_permissions = models.ManyToManyField(Permission,
                              verbose_name=_("Required Permissions"), blank=True)
-    objects = DisplayableManager()
+    objects = managers.ProductManager()
 
     admin_thumb_field = "image"
     list = RichTextField(_("List"),blank=True)
@@ -155,56 +164,53 @@ class Product( Priced, RichText, AdminThumbMixin,Displayable):
         self.save()
     
     def is_magazine(self):
-        for cat in self.categories.all():
-            if cat.title == 'Magazine':
-                return getattr(self,cat.title.lower())
+        if self.category_flags & managers.CATEGORY_FLAG_MAGAZINE:
+            return self.magazine
         return False
     
     def is_article(self):
-        for cat in self.categories.all():
-            if cat.title == 'Article':
-                return getattr(self,cat.title.lower())
+        if self.category_flags & managers.CATEGORY_FLAG_ARTICLE:
+            return self.article
         return False
     
     def is_mag_or_art(self):
-        for cat in self.categories.all():
-            if cat.title in ['Magazine', 'Article']:
-                return (cat.title.lower(),getattr(self, cat.title.lower()))
+        if self.category_flags & managers.CATEGORY_FLAG_MAGAZINE:
+            return ("magazine", self.magazine)
+        if self.category_flags & managers.CATEGORY_FLAG_ARTICLE:
+            return ("article", self.article)
         return (False,None)
     
     def is_sub(self):
-        for cat in self.categories.all():
-            if cat.title in ['Subscription']:
-                return (cat.title.lower(),self)
+        if self.category_flags & managers.CATEGORY_FLAG_SUBSCRIPTION:
+            return ("subscription",self)
         return (False,None)
     
     def is_free(self):
-        for cat in self.categories.all():
-            if cat.title in ['Free']:
-                return True
-        return False
+        return bool(self.category_flags & managers.CATEGORY_FLAG_FREE)
         
     
     def perm_check(self,user):
-        _perms=self._perm_check()
-        if _perms:
-            for _perm in _perms:
-                _perm='_core.'+_perm.codename
+        _codenames=self.required_permission_codenames()
+        if _codenames:
+            for _codename in _codenames:
+                _perm='_core.'+_codename
                 if user.has_perm(_perm) or user.has_perm(_perm,self):
                     return (True,1)
             return (False,1)
         return (True,0)
     
-    def _perm_check(self):
-        _perms=self.required_permissions.all()
-        if _perms:
-            return _perms
-        else:
-            return False
-    
+    def required_permission_codenames(self):
+        """
+        Returns the codenames of the product's required permissions,
+        which are stored on the product, and cached across requests
+        by ``ProductManager.prefetch_required_permissions``.
+        """
+        Product.objects.prefetch_required_permissions([self])
+        return self._required_codenames
+
     def get_file_url(self):
         _mag    =   self.is_magazine()
-        _perms  =   self._perm_check()
+        _perms  =   self.required_permission_codenames()
         if _mag and _mag.pdf:
             if _perms:
                 return "/download/?slug="+_mag.slug
@@ -298,6 +304,8 @@ class ProductVariation(with_metaclass(ProductVariationMetaclass, Priced)):
     default = models.BooleanField(_("Default"), default=False)
     image = models.ForeignKey("ProductImage", verbose_name=_("Image"),
                               null=True, blank=True, on_delete=models.SET_NULL)
+    import_hash = models.CharField(_("Import hash"), max_length=32,
+                                   blank=True, editable=False)
 
     objects = managers.ProductVariationManager()
 
@@ -363,20 +371,14 @@ class ProductVariation(with_metaclass(ProductVariationMetaclass, Priced)):
     def live_num_in_stock(self):
         """
         Returns the live number in stock, which is
-        ``self.num_in_stock - num in carts``. Also caches the value
-        for subsequent lookups.
+        ``self.num_in_stock - num in carts``, with the number in carts
+        read from the ``StockReservation`` ledger. Also caches the
+        value for subsequent lookups.
         """
         if self.num_in_stock is None:
             return None
         if not hasattr(self, "_cached_num_in_stock"):
-            num_in_stock = self.num_in_stock
-            carts = Cart.objects.current()
-            items = CartItem.objects.filter(sku=self.sku, cart__in=carts)
-            aggregate = items.aggregate(quantity_sum=models.Sum("quantity"))
-            num_in_carts = aggregate["quantity_sum"]
-            if num_in_carts is not None:
-                num_in_stock = num_in_stock - num_in_carts
-            self._cached_num_in_stock = num_in_stock
+            ProductVariation.objects.live_stock([self])
         return self._cached_num_in_stock
 
     def has_stock(self, quantity=1):
@@ -396,11 +398,8 @@ class ProductVariation(with_metaclass(ProductVariationMetaclass, Priced)):
         this is the default variation.
         """
         if self.num_in_stock is not None:
+            ProductVariation.objects.add_stock({self.sku: quantity})
             self.num_in_stock += quantity
-            self.save()
-            if self.default:
-                self.product.num_in_stock = self.num_in_stock
-                self.product.save()
 
 
 class Category(Page, RichText):
@@ -425,11 +424,95 @@ class Category(Page, RichText):
         help_text=_("If checked, "
         "products must match all specified filters, otherwise products "
         "can match any specified filter."))
+    membership_stale = models.BooleanField(default=True, editable=False)
+    membership_expiry = models.DateTimeField(null=True, editable=False)
 
     class Meta:
         verbose_name = _("Product category")
         verbose_name_plural = _("Product categories")
 
+    def save(self, *args, **kwargs):
+        """
+        Mark the category's materialised product membership as stale,
+        since its filter fields may have changed.
+        """
+        self.membership_stale = True
+        super(Category, self).save(*args, **kwargs)
+
+    def membership_filters(self):
+        """
+        Returns a product filter as a Q object equivalent to
+        ``filters``, using the category's materialised
+        ``CategoryMembership`` rows. These are rebuilt first if
+        they're stale, or a sale window affecting them has since
+        opened or closed.
+        """
+        expired = self.membership_expiry and self.membership_expiry <= now()
+        if self.membership_stale or expired:
+            self.update_membership()
+        return Q(category_memberships__category=self)
+
+    def update_membership(self, product_ids=None):
+        """
+        Rebuilds the category's ``CategoryMembership`` rows from its
+        filters, adding and removing only the rows that have changed.
+        Also stores the next time a sale starts or ends, after which
+        the filters may match different products. If product IDs are
+        given, only the rows for those products are updated, such as
+        when their variations change, and the category isn't marked
+        as no longer stale.
+        """
+        categories = Category.objects.filter(id=self.id)
+        memberships = self.memberships.all()
+        products = Product.objects.all()
+        variations = ProductVariation.objects.all()
+        partial = product_ids is not None
+        if partial:
+            memberships = memberships.filter(product_id__in=product_ids)
+            products = products.filter(id__in=product_ids)
+            variations = variations.filter(product_id__in=product_ids)
+        with transaction.atomic():
+            if not partial:
+                # Cleared before the filters are read, so that a change
+                # made during the rebuild marks the category stale.
+                categories.update(membership_stale=False)
+            existing = set(memberships.values_list("product_id", flat=True))
+            products = products.filter(self.filters())
+            product_ids = set(products.values_list("id", flat=True))
+            removed = existing - product_ids
+            if removed:
+                self.memberships.filter(product_id__in=removed).delete()
+            added = product_ids - existing
+            try:
+                with transaction.atomic():
+                    CategoryMembership.objects.bulk_create([
+                        CategoryMembership(category=self,
+                                           product_id=product_id)
+                        for product_id in added])
+            except IntegrityError:
+                # Rows were added by a concurrent rebuild since reading
+                # the existing rows, so fall back to one at a time.
+                for product_id in added:
+                    CategoryMembership.objects.get_or_create(
+                        category=self, product_id=product_id)
+            expiry = None
+            if self.sale_id or self.price_min or self.price_max:
+                n = now()
+                boundaries = [variations.filter(**{"%s__gt" % f: n}
+                                  ).aggregate(next=Min(f))["next"]
+                              for f in ("sale_from", "sale_to")]
+                if partial:
+                    # Only some products were read, so the existing
+                    # expiry still applies to the others.
+                    boundaries.append(self.membership_expiry)
+                boundaries = [b for b in boundaries if b is not None]
+                if boundaries:
+                    expiry = min(boundaries)
+            categories.update(membership_expiry=expiry)
+        if not partial:
+            self.membership_stale = False
+        self.membership_expiry = expiry
+
     def filters(self):
         """
         Returns product filters as a Q object for the category.
@@ -479,6 +562,196 @@ class Category(Page, RichText):
         return products
 
 
+class CategoryMembership(models.Model):
+    """
+    Materialised result of a category's filters, so that listing the
+    products in a category is an indexed join. Rebuilt by
+    ``Category.update_membership`` whenever it's marked stale.
+    """
+
+    category = models.ForeignKey("Category", related_name="memberships")
+    product = models.ForeignKey("Product",
+                                related_name="category_memberships")
+
+    class Meta:
+        unique_together = ("category", "product")
+
+
+def variation_filtered_categories():
+    """
+    Returns the categories with filters on variation fields.
+    """
+    return Category.objects.filter(Q(options__isnull=False) |
+                                   Q(sale__isnull=False) |
+                                   Q(price_min__isnull=False) |
+                                   Q(price_max__isnull=False))
+
+
+def update_variation_memberships(product_ids):
+    """
+    Updates the ``CategoryMembership`` rows of the given products in
+    each category with variation filters, when their variations
+    change, rather than marking the categories stale and rebuilding
+    all of their rows on the next request. Stale categories are
+    skipped, since they're rebuilt in full anyway.
+    """
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return
+    categories = variation_filtered_categories().filter(
+        membership_stale=False).distinct()
+    for category in categories:
+        category.update_membership(product_ids)
+
+
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+def variation_category_memberships(sender, instance, **kwargs):
+    """
+    Update the membership of the variation's product in categories
+    with variation filters when a variation changes, unless only
+    fields the filters don't use were saved.
+    """
+    update_fields = kwargs.get("update_fields")
+    if update_fields:
+        filter_fields = ["sale_id", "sale_price", "sale_from", "sale_to",
+                         "unit_price"]
+        filter_fields += [f.name for f in ProductVariation.option_fields()]
+        if not set(update_fields) & set(filter_fields):
+            return
+    update_variation_memberships([instance.product_id])
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def product_categories_stale(sender, instance, action, pk_set, **kwargs):
+    """
+    Mark the membership of categories as stale when products are
+    explicitly assigned to or removed from them.
+    """
+    if not action.startswith("post_") and action != "pre_clear":
+        return
+    categories = Category.objects.all()
+    if isinstance(instance, Category):
+        categories = categories.filter(id=instance.id)
+    elif pk_set:
+        categories = categories.filter(id__in=pk_set)
+    elif action != "pre_clear":
+        return
+    categories.update(membership_stale=True)
+
+
+@receiver(m2m_changed, sender=Category.options.through)
+def category_options_stale(sender, instance, action, **kwargs):
+    """
+    Mark a category's membership as stale when its option filters
+    change.
+    """
+    if action.startswith("post_") and isinstance(instance, Category):
+        Category.objects.filter(id=instance.id).update(membership_stale=True)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_invalidate_cache(sender, instance, **kwargs):
+    """
+    Invalidate the cached product page context for a product.
+    """
+    caching.invalidate_products(instance.id)
+
+
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def product_related_invalidate_cache(sender, instance, **kwargs):
+    """
+    Invalidate the cached product page context for the product of
+    a variation or image.
+    """
+    caching.invalidate_products(instance.product_id)
+
+
+@receiver(m2m_changed, sender=Product.required_permissions.through)
+def required_permissions_invalidate_cache(sender, instance, action, pk_set,
+                                          **kwargs):
+    """
+    Invalidate the cached required permissions of products.
+    """
+    if not action.startswith("post_"):
+        return
+    if isinstance(instance, Product):
+        if hasattr(instance, "_required_codenames"):
+            del instance._required_codenames
+        caching.invalidate_products(instance.id)
+    elif pk_set:
+        caching.invalidate_products(*pk_set)
+    else:
+        caching.invalidate_products()
+
+
+@receiver(m2m_changed, sender=Product.related_products.through)
+def related_products_invalidate_cache(sender, instance, action, pk_set,
+                                      **kwargs):
+    """
+    Invalidate the cached product page context for products whose
+    related products change.
+    """
+    if action.startswith("post_"):
+        caching.invalidate_products(instance.id, *(pk_set or []))
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def product_categories_flags(sender, instance, action, pk_set, **kwargs):
+    """
+    Update the denormalised ``category_flags`` of products when they're
+    assigned to or removed from categories.
+    """
+    if isinstance(instance, Product):
+        if action.startswith("post_"):
+            Product.objects.update_category_flags([instance.id])
+    elif action == "pre_clear":
+        instance._cleared_product_ids = list(
+            instance.products.values_list("id", flat=True))
+    elif action == "post_clear":
+        Product.objects.update_category_flags(instance._cleared_product_ids)
+    elif action.startswith("post_"):
+        Product.objects.update_category_flags(pk_set)
+
+
+@receiver(pre_delete, sender=Category)
+def category_delete_flags(sender, instance, **kwargs):
+    """
+    Store the products of a category being deleted, for updating their
+    ``category_flags`` once it's deleted.
+    """
+    instance._deleted_product_ids = list(
+        instance.products.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_products_flags(sender, instance, **kwargs):
+    """
+    Update the denormalised ``category_flags`` of a category's products
+    when its title or keywords may have changed, or it's deleted.
+    """
+    product_ids = getattr(instance, "_deleted_product_ids", None)
+    if product_ids is None:
+        product_ids = list(instance.products.values_list("id", flat=True))
+    Product.objects.update_category_flags(product_ids)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(m2m_changed, sender=Product.categories.through)
+def category_invalidate_cache(sender, **kwargs):
+    """
+    Invalidate the cached product page context for all products when
+    categories change, since they include their categories' keywords.
+    """
+    caching.invalidate_products()
+
+
 @python_2_unicode_compatible
 class Order(SiteRelated):
 
@@ -549,21 +822,7 @@ class Order(SiteRelated):
         
         self.key = request.session.session_key
         self.user_id = request.user.id
-        for field in self.session_fields:
-            if field in request.session:
-                setattr(self, field, request.session[field])
-        self.total = self.item_total = request.cart.total_price()
-        
-        if self.shipping_total is not None:
-            self.shipping_total = Decimal(str(self.shipping_total))
-            self.total += self.shipping_total
-            
-        if self.discount_total is not None:
-            self.total -= Decimal(self.discount_total)
-            
-        if self.tax_total is not None:
-            self.total += Decimal(self.tax_total)
-        self.total = round(self.total,2)
+        self._set_totals(request)
         self.save()  # We need an ID before we can add related items.
         
         for item in request.cart:
@@ -580,18 +839,25 @@ class Order(SiteRelated):
         
         self.key = request.session.session_key
         self.user_id = request.user.id
+        self._set_totals(request)
+
+    def _set_totals(self, request):
+        """
+        Set order fields that are stored in the session, and the
+        totals for the cart given by ``cart_totals``. The cart's
+        summary is cleared first, so that the amount charged is
+        totalled from the same items copied to the order, rather than
+        from a summary that a concurrent request may have left stale.
+        """
         for field in self.session_fields:
             if field in request.session:
                 setattr(self, field, request.session[field])
-        self.total = self.item_total = request.cart.total_price()
-        if self.shipping_total is not None:
-            self.shipping_total = Decimal(str(self.shipping_total))
-            self.total += self.shipping_total
-        if self.discount_total is not None:
-            self.total -= Decimal(self.discount_total)
-        if self.tax_total is not None:
-            self.total += Decimal(self.tax_total)
-        
+        request.cart.summary = None
+        totals = cart_totals(request)
+        for field in ("item_total", "shipping_total", "discount_total",
+                      "tax_total"):
+            setattr(self, field, totals[field])
+        self.total = totals["order_total"]
 
     def complete(self, request,express=False):
         """
@@ -604,17 +870,9 @@ class Order(SiteRelated):
         self.save()  # Save the transaction ID.
         discount_code = request.session.get('discount_code')
         clear_session(request, "%sorder"%_express, *self.session_fields)
-        for item in request.cart:
-            try:
-                variation = ProductVariation.objects.get(sku=item.sku)
-            except ProductVariation.DoesNotExist:
-                pass
-            else:
-                variation.update_stock(item.quantity * -1)
-                variation.product.actions.purchased()
+        request.cart.purchase()
         if discount_code:
-            DiscountCode.objects.active().filter(code=discount_code).update(
-                uses_remaining=models.F('uses_remaining') - 1)
+            DiscountReservation.objects.redeem(discount_code, request.cart)
         request.cart.delete()
         del request.session['cart']
 
@@ -644,54 +902,45 @@ class Order(SiteRelated):
     invoice.short_description = ""
 
 
-class Cart(models.Model):
+class CartBase(object):
+    """
+    Template helpers and calculations for carts, based only on
+    iterating over the cart's items. Shared by the ``Cart`` model and
+    carts kept in the session or cache by ``cartridge.shop.carts``.
+    """
 
-    last_updated = models.DateTimeField(_("Last updated"), null=True)
+    # Dict of totals for the cart's items, as returned by ``summarize``,
+    # which when assigned is used by the template helpers below rather
+    # than loading the items.
+    summary = None
 
-    objects = managers.CartManager()
-
-    def __iter__(self):
+    def summarize(self):
         """
-        Allow the cart to be iterated giving access to the cart's items,
-        ensuring the items are only retrieved once and cached.
+        Returns a dict of the number of items, total quantity, total
+        price and whether any items need shipping, for storing as the
+        cart's summary.
         """
-        if not hasattr(self, "_cached_items"):
-            self._cached_items = self.items.all()
-        return iter(self._cached_items)
-
-    def add_item(self, variation, quantity):
-        """
-        Increase quantity of existing item if SKU matches, otherwise create
-        new.
-        """
-        if not self.pk:
-            self.save()
-        _print=False
-        for cat in variation.product.categories.all():
-            if 'print' in cat.keywords_string:
-                _print=True
-        kwargs = {"sku": variation.sku, "unit_price": variation.price(),'can_ship':_print}
-        item, created = self.items.get_or_create(**kwargs)
-        if created:
-            item.description = force_text(variation)
-            item.unit_price = variation.price()
-            item.url = variation.product.get_absolute_url()
-            image = variation.image
-            if image is not None:
-                item.image = force_text(image.file)
-            variation.product.actions.added_to_cart()
-        item.quantity += quantity
-        item.save()
+        items = list(self)
+        return {
+            "items": len(items),
+            "quantity": sum([item.quantity for item in items]),
+            "total": sum([item.total_price for item in items]),
+            "ship": any([item.can_ship for item in items]),
+        }
 
     def has_items(self):
         """
         Template helper function - does the cart have items?
         """
+        if self.summary is not None:
+            return self.summary["items"] > 0
         return len(list(self)) > 0
     
     def need_to_ship(self):
+        if self.summary is not None:
+            return self.summary["ship"]
         _ship=False
-        for item in self.items.all():
+        for item in self:
             if item.can_ship:
                 _ship=True
                 break
@@ -701,12 +950,16 @@ class Cart(models.Model):
         """
         Template helper function - sum of all item quantities.
         """
+        if self.summary is not None:
+            return self.summary["quantity"]
         return sum([item.quantity for item in self])
 
     def total_price(self):
         """
         Template helper function - sum of all costs of item quantities.
         """
+        if self.summary is not None:
+            return self.summary["total"]
         return sum([item.total_price for item in self])
 
     def skus(self):
@@ -733,22 +986,160 @@ class Cart(models.Model):
         Calculates the discount based on the items in a cart, some
         might have the discount, others might not.
         """
+        return self.discount_total(discount, self.discount_skus(discount))
+
+    def discount_skus(self, discount):
+        """
+        Returns the set of SKUs in the cart that the discount applies
+        to, or ``None`` if the discount isn't product specific.
+        """
+        skus = discount.applicable_skus()
+        if skus is None:
+            return None
+        return skus & set(self.skus())
+
+    def discount_total(self, discount, discount_skus):
+        """
+        Totals the discount for the items in the cart with the given
+        SKUs, as returned by ``discount_skus``.
+        """
         # Discount applies to cart total if not product specific.
-        products = discount.all_products()
-        if products.count() == 0:
+        if discount_skus is None:
             return discount.calculate(self.total_price())
         total = Decimal("0")
-        # Create a list of skus in the cart that are applicable to
-        # the discount, and total the discount for appllicable items.
-        lookup = {"product__in": products, "sku__in": self.skus()}
-        discount_variations = ProductVariation.objects.filter(**lookup)
-        discount_skus = discount_variations.values_list("sku", flat=True)
         for item in self:
             if item.sku in discount_skus:
                 total += discount.calculate(item.unit_price) * item.quantity
         return total
 
 
+class Cart(CartBase, models.Model):
+
+    last_updated = models.DateTimeField(_("Last updated"), null=True)
+
+    objects = managers.CartManager()
+
+    # Set by ``CartManager.from_request`` when the cart's timestamp
+    # wasn't updated, so the cart may no longer exist.
+    unconfirmed = False
+
+    def __iter__(self):
+        """
+        Allow the cart to be iterated giving access to the cart's items,
+        ensuring the items are only retrieved once and cached.
+        """
+        if not hasattr(self, "_cached_items"):
+            self._cached_items = self.items.all()
+        return iter(self._cached_items)
+
+    def delete(self, *args, **kwargs):
+        """
+        Release the stock reserved by the cart's items, which are
+        removed via a cascading delete that bypasses
+        ``CartItem.delete``, and any discount code use reserved for
+        the cart.
+        """
+        quantities = Cart.objects.filter(id=self.id).item_quantities()
+        with transaction.atomic():
+            StockReservation.objects.release(quantities)
+            DiscountReservation.objects.filter(cart_id=self.id).release()
+            super(Cart, self).delete(*args, **kwargs)
+        self.summary = None
+
+    def add_item(self, variation, quantity):
+        """
+        Increase quantity of existing item if SKU matches, otherwise create
+        new.
+        """
+        if not self.pk or self.unconfirmed:
+            self.save()
+            self.unconfirmed = False
+        _print=bool(variation.product.category_flags &
+                    managers.CATEGORY_FLAG_PRINT)
+        kwargs = {"sku": variation.sku, "unit_price": variation.price(),'can_ship':_print}
+        item, created = self.items.get_or_create(**kwargs)
+        if created:
+            item.description = force_text(variation)
+            item.unit_price = variation.price()
+            item.url = variation.product.get_absolute_url()
+            image = variation.image
+            if image is not None:
+                item.image = force_text(image.file)
+            variation.product.actions.added_to_cart()
+        item.quantity += quantity
+        item.save()
+        self.summary = None
+
+    # Set by ``remove_stock`` once the cart's items have been removed
+    # from stock before payment, so ``purchase`` doesn't remove them
+    # again.
+    stock_removed = False
+
+    def item_quantities(self):
+        """
+        Returns a dict of SKUs mapped to the total quantity of each in
+        the cart.
+        """
+        quantities = defaultdict(int)
+        for item in self:
+            quantities[item.sku] += item.quantity
+        return quantities
+
+    def remove_stock(self):
+        """
+        Removes the cart's items from stock before payment, returning
+        the list of SKUs without enough stock, in which case no stock
+        is removed and the order should be rejected.
+        """
+        failed = ProductVariation.objects.remove_stock(self.item_quantities())
+        self.stock_removed = not failed
+        return failed
+
+    def restore_stock(self):
+        """
+        Returns the stock removed by ``remove_stock`` when payment
+        fails.
+        """
+        if self.stock_removed:
+            ProductVariation.objects.add_stock(self.item_quantities())
+            self.stock_removed = False
+
+    def purchase(self):
+        """
+        Called when an order for the cart is complete. Removes the
+        cart's items from stock, unless already removed by
+        ``remove_stock``, and records each of their products as
+        purchased, as a single transaction performing a fixed number
+        of queries regardless of the number of items in the cart.
+        Returns the list of SKUs whose stock went negative, which is
+        only possible when payment was taken without ``remove_stock``
+        being called first, such as for PayPal IPN callbacks.
+        """
+        quantities = self.item_quantities()
+        if not quantities:
+            return
+        variations = ProductVariation.objects.filter(sku__in=list(quantities))
+        products = dict(variations.values_list("sku", "product_id"))
+        purchases = defaultdict(int)
+        for item in self:
+            if item.sku in products:
+                purchases[products[item.sku]] += 1
+        oversold = []
+        with transaction.atomic():
+            if not self.stock_removed:
+                oversold = ProductVariation.objects.remove_stock(quantities)
+            if oversold:
+                # Payment has already been taken, so the stock is
+                # removed even though it's no longer available, and
+                # the SKUs are logged for the order to be followed up.
+                logger.warning("Stock oversold for SKUs: %s",
+                               ", ".join(oversold))
+                removed = [(sku, -num) for sku, num in quantities.items()]
+                ProductVariation.objects.add_stock(dict(removed))
+            ProductAction.objects.record("total_purchase", purchases)
+        return oversold
+
+
 @python_2_unicode_compatible
 class SelectedProduct(models.Model):
     """
@@ -787,9 +1178,58 @@ class CartItem(SelectedProduct):
     image = CharField(max_length=200, null=True)
     can_ship = models.BooleanField(default=False)
 
+    # Quantity last recorded against the item's SKU in the
+    # ``StockReservation`` ledger, used to apply only the change in
+    # quantity when the item is saved.
+    _reserved_quantity = 0
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        item = super(CartItem, cls).from_db(db, field_names, values)
+        item._reserved_quantity = item.quantity
+        return item
+
     def get_absolute_url(self):
         return self.url
 
+    def save(self, *args, **kwargs):
+        """
+        Apply the change in quantity to the stock reservation ledger.
+        ``SelectedProduct.save`` deletes the item when its quantity is
+        zero, in which case ``delete`` releases it instead.
+        """
+        with transaction.atomic():
+            super(CartItem, self).save(*args, **kwargs)
+            if self.id is not None:
+                quantity = self.quantity - self._reserved_quantity
+                StockReservation.objects.reserve(self.sku, quantity)
+                self._reserved_quantity = self.quantity
+
+    def delete(self, *args, **kwargs):
+        """
+        Release the item's quantity from the stock reservation ledger.
+        """
+        with transaction.atomic():
+            StockReservation.objects.release({self.sku:
+                                              self._reserved_quantity})
+            self._reserved_quantity = 0
+            super(CartItem, self).delete(*args, **kwargs)
+
+
+class StockReservation(models.Model):
+    """
+    Ledger of the total quantity of each SKU held in carts, kept up to
+    date as cart items are added, updated and removed, and as expired
+    carts are deleted. This allows the live number in stock for a
+    variation to be read from a single row, rather than aggregating
+    the items across every current cart.
+    """
+
+    sku = fields.SKUField(unique=True)
+    quantity = models.IntegerField(_("Quantity"), default=0)
+
+    objects = managers.StockReservationManager()
+
 
 class OrderItem(SelectedProduct):
     """
@@ -802,8 +1242,8 @@ class ProductAction(models.Model):
     """
     Records an incremental value for an action against a product such
     as adding to cart or purchasing, for sales reporting and
-    calculating popularity. Not yet used but will be used for product
-    popularity and sales reporting.
+    calculating popularity, which is denormalised onto
+    ``Product.popularity`` as actions are recorded.
     """
 
     product = models.ForeignKey("Product", related_name="actions")
@@ -856,6 +1296,21 @@ class Discount(models.Model):
         filters = reduce(ior, filters + [Q(id__in=self.products.only("id"))])
         return Product.objects.filter(filters).distinct()
 
+    def applicable_skus(self):
+        """
+        Returns the set of SKUs the discount applies to, or ``None`` if
+        it isn't product specific, cached according to the
+        ``SHOP_DISCOUNT_CACHE_SECONDS`` setting.
+        """
+        def load(discount):
+            products = discount.all_products()
+            variations = ProductVariation.objects.filter(product__in=products)
+            skus = set(variations.values_list("sku", flat=True))
+            if not skus and not products.exists():
+                return None
+            return skus
+        return caching.discount_skus(self, load)
+
 
 class Sale(Discount):
     """
@@ -924,6 +1379,8 @@ class Sale(Discount):
                             priced.save()
                         except Warning:
                             connection.set_rollback(False)
+            caching.invalidate_products()
+            caching.invalidate_discounts()
 
     def delete(self, *args, **kwargs):
         """
@@ -941,6 +1398,9 @@ class Sale(Discount):
                   "sale_from": None, "sale_to": None}
         for priced_model in (Product, ProductVariation):
             priced_model.objects.filter(sale_id=self.id).update(**update)
+        variation_filtered_categories().update(membership_stale=True)
+        caching.invalidate_products()
+        caching.invalidate_discounts()
 
 
 @receiver(m2m_changed, sender=Sale.products.through)
@@ -985,10 +1445,49 @@ class DiscountCode(Discount):
     class Meta:
         verbose_name = _("Discount code")
         verbose_name_plural = _("Discount codes")
+
+
+class DiscountReservation(models.Model):
+    """
+    A use of a discount code with limited uses remaining, reserved
+    for a cart when the code is applied, so that concurrent checkouts
+    can't use the code more times than remain. The use is returned to
+    the code when the cart is deleted or payment fails, and committed
+    when the order is complete.
+    """
+
+    discount = models.ForeignKey("DiscountCode", related_name="reservations")
+    cart = models.OneToOneField("Cart", related_name="discount_reservation")
+
+    objects = managers.DiscountReservationManager()
         
         
 
 
+@receiver(post_save, sender=DiscountCode)
+@receiver(post_delete, sender=DiscountCode)
+@receiver(m2m_changed, sender=DiscountCode.products.through)
+@receiver(m2m_changed, sender=DiscountCode.categories.through)
+@receiver(post_save, sender=Sale)
+@receiver(post_delete, sender=Sale)
+@receiver(m2m_changed, sender=Sale.products.through)
+@receiver(m2m_changed, sender=Sale.categories.through)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(m2m_changed, sender=Category.options.through)
+@receiver(m2m_changed, sender=Product.categories.through)
+def discounts_invalidate_cache(sender, **kwargs):
+    """
+    Invalidate the cached SKUs that discounts apply to when discounts,
+    or the products and categories they're assigned, change.
+    """
+    caching.invalidate_discounts()
+
+
 # ...
 
 
@@ -1013,6 +1512,8 @@ def payment_complete(sender, **kwargs):
             try:
                 order = Order.objects.get(
                     transaction_id=ipn_obj.invoice)
+                # Read before the session fields are cleared below.
+                code = session.get('discount_code')
                 for field in order.session_fields:
                     if field in session:
                         del session[field]
@@ -1026,20 +1527,12 @@ def payment_complete(sender, **kwargs):
                 # save after modifying its data.
                 session.save()
 
-                for item in cart:
-                    try:
-                        variation = ProductVariation.objects.get(
-                            sku=item.sku)
-                    except ProductVariation.DoesNotExist:
-                        pass
-                    else:
-                        variation.update_stock(item.quantity * -1)
-                        variation.product.actions.purchased()
+                cart.purchase()
 
-                code = session.get('discount_code')
+                # Commit the use reserved for the cart before deleting
+                # it, which would otherwise release the reservation.
                 if code:
-                    DiscountCode.objects.active().filter(code=code) \
-                        .update(uses_remaining=F('uses_remaining') - 1)
+                    DiscountReservation.objects.redeem(code, cart)
                 cart.delete()
             except Order.DoesNotExist:
                 pass
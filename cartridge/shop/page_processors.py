@@ -7,6 +7,7 @@ from mezzanine.pages.page_processors import processor_for
 from mezzanine.utils.views import paginate
 
 from cartridge.shop.models import Category, Product
+from cartridge.shop.utils import keyset_paginate
 
 
 @processor_for(Category, exact_page=True)
@@ -16,15 +17,27 @@ def category_processor(request, page):
     """
     settings.use_editable()
     products = Product.objects.published(for_user=request.user
-                                ).filter(page.category.filters()).distinct()
+                                ).filter(page.category.membership_filters())
     sort_options = [(slugify(option[0]), option[1])
                     for option in settings.SHOP_PRODUCT_SORT_OPTIONS]
     sort_by = request.GET.get("sort", sort_options[0][1])
-    products = paginate(products.order_by(sort_by),
-                        request.GET.get("page", 1),
-                        settings.SHOP_PER_PAGE_CATEGORY,
-                        settings.MAX_PAGING_LINKS)
+    if settings.SHOP_KEYSET_PAGINATION:
+        if sort_by not in [option[1] for option in sort_options]:
+            sort_by = sort_options[0][1]
+        products = keyset_paginate(products, sort_by,
+                                   request.GET.get("cursor"),
+                                   settings.SHOP_PER_PAGE_CATEGORY,
+                                   request.GET)
+    else:
+        products = paginate(products.order_by(sort_by),
+                            request.GET.get("page", 1),
+                            settings.SHOP_PER_PAGE_CATEGORY,
+                            settings.MAX_PAGING_LINKS)
     products.sort_by = sort_by
+    # Load the required permissions of the page's products at once,
+    # for templates checking them for each product.
+    products.object_list = list(products.object_list)
+    Product.objects.prefetch_required_permissions(products.object_list)
     sub_categories = page.category.children.published()
     child_categories = Category.objects.filter(id__in=sub_categories)
     return {"products": products, "child_categories": child_categories}
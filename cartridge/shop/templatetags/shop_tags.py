@@ -8,7 +8,7 @@ import platform
 
 from django import template
 
-from cartridge.shop.utils import set_locale
+from cartridge.shop.utils import cart_totals, set_locale
 
 
 register = template.Library()
@@ -35,37 +35,16 @@ def _order_totals(context):
     """
     Add shipping/tax/discount/order types and totals to the template
     context. Use the context's completed order object for email
-    receipts, or the cart object for checkout.
+    receipts, or the cart totals for checkout.
     """
+    if "order" not in context:
+        return cart_totals(context["request"])
     fields = ["shipping_type", "shipping_total", "discount_total",
-              "tax_type", "tax_total"]
+              "tax_type", "tax_total", "item_total"]
     template_vars = {}
-
-    if "order" in context:
-        for field in fields + ["item_total"]:
-            template_vars[field] = getattr(context["order"], field)
-    else:
-        template_vars["item_total"] = context["request"].cart.total_price()
-        if template_vars["item_total"] == 0:
-            # Ignore session if cart has no items, as cart may have
-            # expired sooner than the session.
-            template_vars["tax_total"] = 0
-            template_vars["discount_total"] = 0
-            template_vars["shipping_total"] = 0
-        else:
-            for field in fields:
-                template_vars[field] = context["request"].session.get(
-                    field, None)
-    template_vars["order_total"] = template_vars.get("item_total", None)
-    if template_vars.get("shipping_total", None) is not None:
-        template_vars["order_total"] += Decimal(
-            str(template_vars["shipping_total"]))
-    if template_vars.get("discount_total", None) is not None:
-        template_vars["order_total"] -= Decimal(
-            str(template_vars["discount_total"]))
-    if template_vars.get("tax_total", None) is not None:
-        template_vars["order_total"] += Decimal(
-            str(template_vars["tax_total"]))
+    for field in fields:
+        template_vars[field] = getattr(context["order"], field)
+    template_vars["order_total"] = context["order"].total
     return template_vars
 
 
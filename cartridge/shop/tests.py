@@ -1,15 +1,26 @@
 from __future__ import division, unicode_literals
 from future.builtins import range, zip
 
-from datetime import timedelta
+import csv
+import gzip
+import json
+import os
+import sys
+from datetime import date, timedelta
 from decimal import Decimal
 from operator import mul
+from tempfile import NamedTemporaryFile
 from functools import reduce
 from unittest import skipUnless
 
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from mezzanine.conf import settings
@@ -21,16 +32,30 @@ from mezzanine.utils.tests import run_pep8_for_package
 from cartridge.shop.models import Product, ProductOption, ProductVariation
 from cartridge.shop.models import ProductImage
 from cartridge.shop.models import Category, Cart, Order, DiscountCode
-from cartridge.shop.models import Sale
-from cartridge.shop.forms import OrderForm
+from cartridge.shop.models import CategoryMembership
+from cartridge.shop.models import DiscountReservation, payment_complete
+from cartridge.shop.models import Sale, StockReservation, ProductAction
+from cartridge.shop.managers import popularity_score
+from cartridge.shop.carts import cart_from_request
+from cartridge.shop.forms import CartItemFormSet, OrderForm
+from cartridge.shop.middleware import ShopMiddleware
+from cartridge.shop import actions, checkout
 from cartridge.shop.checkout import CHECKOUT_STEPS
-from cartridge.shop.utils import set_tax
+from cartridge.shop.utils import cart_totals, keyset_paginate, set_tax
 
 
 TEST_STOCK = 5
 TEST_PRICE = Decimal("20")
 
 
+def custom_tax_handler(request, order_form):
+    set_tax(request, "Custom", 1)
+
+
+def failing_payment_handler(request, order_form, order):
+    raise KeyError("gateway")
+
+
 class ShopTests(TestCase):
 
     def setUp(self):
@@ -185,6 +210,287 @@ class ShopTests(TestCase):
         self._category.combined = False
         self.assertCategoryFilteredProducts(1)
 
+    def test_category_membership(self):
+        """
+        Test the materialised category membership is rebuilt when
+        products, variations and category filters change.
+        """
+        def members():
+            category = Category.objects.get(id=self._category.id)
+            products = Product.objects.filter(category.membership_filters())
+            return products.count()
+
+        self.assertEqual(members(), 0)
+        self._category.products.add(self._product)
+        self.assertEqual(members(), 1)
+        self._category.products.remove(self._product)
+        self.assertEqual(members(), 0)
+        option_field, options = list(self._options.items())[0]
+        self._product.variations.all().delete()
+        option = ProductOption.objects.get(type=option_field[-1],
+                                           name=options[0])
+        self._category.options.add(option)
+        self.assertEqual(members(), 0)
+        self._product.variations.create_from_options(
+            {option_field: [options[0]]})
+        self.assertEqual(members(), 1)
+        self._category.price_min = TEST_PRICE
+        self._category.save()
+        self.assertEqual(members(), 0)
+        variation = self._product.variations.get()
+        variation.sale_price = TEST_PRICE
+        variation.sale_from = now() + timedelta(seconds=1)
+        variation.save()
+        self.assertEqual(members(), 0)
+        Category.objects.filter(id=self._category.id).update(
+            membership_expiry=now())
+        ProductVariation.objects.update(sale_from=now())
+        self.assertEqual(members(), 1)
+        # Saving a variation updates its product's rows in place,
+        # rather than leaving the category stale for the next request.
+        memberships = CategoryMembership.objects.filter(
+            category=self._category)
+        variation = self._product.variations.get()
+        variation.sale_price = 0
+        variation.save()
+        self.assertFalse(memberships.exists())
+        variation.sale_price = TEST_PRICE
+        variation.save()
+        self.assertTrue(memberships.exists())
+        self.assertFalse(Category.objects.get(
+            id=self._category.id).membership_stale)
+        # A concurrent rebuild adding the same rows, and a change
+        # made during the rebuild, are both tolerated.
+        category = Category.objects.get(id=self._category.id)
+        filters = category.filters
+
+        def concurrent_filters():
+            CategoryMembership.objects.create(category=category,
+                                              product=self._product)
+            Category.objects.filter(id=category.id).update(
+                membership_stale=True)
+            return filters()
+
+        category.memberships.all().delete()
+        category.filters = concurrent_filters
+        category.update_membership()
+        self.assertEqual(category.memberships.count(), 1)
+        self.assertTrue(Category.objects.get(id=category.id).membership_stale)
+
+    def test_keyset_pagination(self):
+        """
+        Test following cursors with keyset pagination visits every
+        product once, in order, with NULL values last.
+        """
+        for price in (None, 1, 2, 2, None, 3):
+            Product.objects.create(unit_price=price, **self._published)
+        products = Product.objects.all()
+        for order_by in ("unit_price", "-unit_price"):
+            expected = sorted(products, key=lambda p: p.id,
+                              reverse=order_by.startswith("-"))
+            expected = sorted(expected, key=lambda p: p.unit_price or 0,
+                              reverse=order_by.startswith("-"))
+            expected = sorted(expected, key=lambda p: p.unit_price is None)
+            visited, cursor = [], None
+            while True:
+                page = keyset_paginate(products, order_by, cursor, 2)
+                visited.extend(page.object_list)
+                cursor = page.next_cursor
+                if cursor is None:
+                    break
+            self.assertEqual(visited, expected)
+        with override_settings(SHOP_KEYSET_PAGINATION=True):
+            response = self.client.get(self._category.get_absolute_url(),
+                                       {"cursor": "invalid"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_product_cache(self):
+        """
+        Test the product page context is cached, and invalidated when
+        the product's variations change.
+        """
+        self._reset_variations()
+        url = self._product.get_absolute_url()
+
+        def get():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            return response, len(queries)
+
+        with override_settings(SHOP_PRODUCT_CACHE_SECONDS=60):
+            response, cold = get()
+            response, warm = get()
+            self.assertTrue(warm < cold)
+            variation = self._product.variations.all()[0]
+            variation.unit_price = TEST_PRICE + 1
+            variation.save()
+            response, num_queries = get()
+        self.assertTrue(num_queries > warm)
+        prices = [v.unit_price for v in response.context["variations"]]
+        self.assertTrue(TEST_PRICE + 1 in prices)
+
+    def test_category_flags(self):
+        """
+        Test product category flags are kept up to date as products
+        are assigned to categories, and categories change.
+        """
+        flags = lambda: Product.objects.get(id=self._product.id)
+        free = Category.objects.create(title="Free",
+                                       status=CONTENT_STATUS_PUBLISHED)
+        self.assertFalse(flags().is_free())
+        free.products.add(self._product)
+        self.assertTrue(flags().is_free())
+        self.assertEqual(flags().is_sub(), (False, None))
+        free.title = "Subscription"
+        free.save()
+        self.assertFalse(flags().is_free())
+        self.assertEqual(flags().is_sub()[0], "subscription")
+        self._product.categories.clear()
+        self.assertEqual(flags().category_flags, 0)
+
+    def test_perm_check_many(self):
+        """
+        Test checking required permissions for many products performs
+        a constant number of queries, and sees permission changes.
+        """
+        permission = Permission.objects.all()[0]
+        User.objects.create(username="test")
+
+        def num_queries(num_products):
+            products = [Product.objects.create(**self._published)
+                        for i in range(num_products)]
+            products[0].required_permissions.add(permission)
+            products = list(Product.objects.filter(
+                id__in=[product.id for product in products]))
+            # Fetch the user each time since it caches its permissions.
+            user = User.objects.get(username="test")
+            with CaptureQueriesContext(connection) as queries:
+                results = Product.objects.perm_check_many(user, products)
+            self.assertEqual(results[products[0].id], (False, 1))
+            self.assertEqual(results[products[-1].id], (True, 0))
+            return len(queries)
+
+        with override_settings(SHOP_PRODUCT_CACHE_SECONDS=60):
+            self.assertEqual(num_queries(2), num_queries(10))
+        # Products listed on category pages have their permissions
+        # loaded at once.
+        self._category.products.add(self._product)
+        response = self.client.get(self._category.get_absolute_url())
+        products = list(response.context["products"])
+        self.assertEqual(products, [self._product])
+        self.assertTrue(hasattr(products[0], "_required_codenames"))
+
+    def test_lazy_cart(self):
+        """
+        Test the cart is only retrieved when it's used, and isn't
+        retrieved at all for URLs in SHOP_CART_SKIP_URL_PREFIXES.
+        """
+        self._reset_variations()
+        self._add_to_cart(self._product.variations.all()[0], 1)
+        cart_id = self.client.session["cart"]
+        last_updated = now() - timedelta(minutes=1)
+        Cart.objects.update(last_updated=last_updated)
+        request = RequestFactory().get("/")
+        request.session = {"cart": cart_id}
+        ShopMiddleware().process_request(request)
+        self.assertEqual(Cart.objects.get().last_updated, last_updated)
+        self.assertEqual(request.cart.id, cart_id)
+        self.assertTrue(Cart.objects.get().last_updated > last_updated)
+        with override_settings(SHOP_CART_SKIP_URL_PREFIXES=["/static/"]):
+            request = RequestFactory().get("/static/shop.css")
+            request.session = {"cart": cart_id}
+            ShopMiddleware().process_request(request)
+        self.assertEqual(request.cart.id, None)
+        self.assertFalse(request.cart.has_items())
+
+    def test_cart_summary(self):
+        """
+        Test the cart's totals are given by the summary stored in the
+        session, without loading the cart's items.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, 2)
+        request = RequestFactory().get("/")
+        request.session = self.client.session
+        cart = cart_from_request(request)
+        with self.assertNumQueries(0):
+            self.assertTrue(cart.has_items())
+            self.assertEqual(cart.total_quantity(), 2)
+            self.assertEqual(cart.total_price(), variation.unit_price * 2)
+        self.assertEqual(cart.summary, cart.summarize())
+
+    def test_cart_totals(self):
+        """
+        Test the cart totals are computed from the cart and the session,
+        and only recomputed when the session's pricing values change.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, 1)
+        request = RequestFactory().get("/")
+        request.session = self.client.session
+        request.cart = Cart.objects.from_request(request)
+        set_tax(request, "Tax", "1.50")
+        totals = cart_totals(request)
+        self.assertEqual(totals["order_total"], variation.unit_price +
+                         Decimal("1.50"))
+        with self.assertNumQueries(0):
+            self.assertEqual(cart_totals(request), totals)
+            set_tax(request, "Tax", "2.50")
+            self.assertEqual(cart_totals(request)["tax_total"],
+                             Decimal("2.50"))
+        # Orders are totalled from the cart's items, not its summary.
+        request.cart.summary = dict(request.cart.summarize(), total=1)
+        order = Order()
+        order._set_totals(request)
+        self.assertEqual(order.item_total, variation.unit_price)
+
+    def test_cart_heartbeat(self):
+        """
+        Test the cart's timestamp is only updated once the heartbeat
+        fraction of the expiry time has passed, and that a cart
+        deleted in the meantime is recreated when added to.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        with override_settings(SHOP_CART_HEARTBEAT_FRACTION=0.5):
+            self._add_to_cart(variation, 1)
+            last_updated = now() - timedelta(minutes=1)
+            Cart.objects.update(last_updated=last_updated)
+            self.client.get(reverse("shop_cart"))
+            self.assertEqual(Cart.objects.get().last_updated, last_updated)
+            Cart.objects.all().delete()
+            self._add_to_cart(variation, 1)
+        self.assertEqual(Cart.objects.get().total_quantity(), 1)
+
+    def test_stored_cart(self):
+        """
+        Test a cart kept in the session isn't written to the database
+        until checkout starts, and can be updated from the cart page.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        with override_settings(SHOP_CART_STORAGE="session"):
+            self._add_to_cart(variation, 2)
+            self.assertEqual(Cart.objects.count(), 0)
+            response = self.client.get(reverse("shop_cart"))
+            self.assertEqual(response.context["request"].cart.skus(),
+                             [variation.sku])
+            data = {"items-INITIAL_FORMS": 1, "items-TOTAL_FORMS": 1,
+                    "items-0-id": variation.sku, "items-0-quantity": 3,
+                    "update_cart": 1}
+            # A SKU that isn't in the cart is a form error.
+            response = self.client.post(reverse("shop_cart"),
+                                        dict(data, **{"items-0-id": "x"}))
+            self.assertEqual(response.status_code, 200)
+            self.client.post(reverse("shop_cart"), data)
+            self.assertEqual(Cart.objects.count(), 0)
+            self.client.get(reverse("shop_checkout"))
+        cart = Cart.objects.get()
+        self.assertEqual(cart.total_quantity(), 3)
+        self.assertEqual(self.client.session["cart"], cart.id)
+
     def _add_to_cart(self, variation, quantity):
         """
         Given a variation, creates the dict for posting to the cart
@@ -261,6 +567,193 @@ class ShopTests(TestCase):
         self.assertEqual(cart.total_quantity(), 0)
         self.assertEqual(cart.total_price(), Decimal("0"))
 
+    def test_stock_reservations(self):
+        """
+        Test the stock reservation ledger is kept up to date as items
+        are added to and removed from carts, and when carts expire.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        reserved = lambda: StockReservation.objects.reserved(
+            [variation.sku])[variation.sku]
+        self._add_to_cart(variation, TEST_STOCK)
+        self._add_to_cart(variation, 1)
+        self.assertEqual(reserved(), TEST_STOCK + 1)
+        quantities = {variation.sku: TEST_STOCK}
+        without_stock = ProductVariation.objects.without_stock(quantities)
+        self.assertEqual(without_stock, [variation.sku])
+        cart = Cart.objects.from_request(self.client)
+        self._empty_cart(cart)
+        self.assertEqual(reserved(), 0)
+        self.assertEqual(ProductVariation.objects.without_stock(quantities),
+                         [])
+        # Expire the cart and check its items are released.
+        self._add_to_cart(variation, TEST_STOCK)
+        expired = now() - timedelta(minutes=settings.SHOP_CART_EXPIRY_MINUTES)
+        Cart.objects.update(last_updated=expired - timedelta(minutes=1))
+        self.assertEqual(reserved(), 0)
+        Cart.objects.expired().delete()
+        self.assertEqual(reserved(), 0)
+        # Expire carts in batches with the expire_carts command.
+        for i in range(3):
+            self._add_to_cart(variation, 1)
+            self.client.cookies.clear()
+        self.assertEqual(reserved(), 3)
+        Cart.objects.update(last_updated=expired - timedelta(minutes=1))
+        call_command("expire_carts", batch_size=2, verbosity=0)
+        self.assertEqual(reserved(), 0)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_cart_formset_queries(self):
+        """
+        Test that the number of queries performed validating the cart
+        formset doesn't grow with the number of items in the cart.
+        """
+        self._product.variations.all().delete()
+        self._product.variations.create_from_options(self._options)
+        self._product.variations.update(unit_price=TEST_PRICE,
+                                        num_in_stock=TEST_STOCK)
+        variations = list(self._product.variations.all())
+
+        def num_queries(num_items):
+            cart = Cart.objects.create(last_updated=now())
+            for variation in variations[:num_items]:
+                cart.add_item(variation, 1)
+            data = {"items-INITIAL_FORMS": num_items,
+                    "items-TOTAL_FORMS": num_items}
+            for i, item in enumerate(cart.items.all()):
+                data["items-%s-id" % i] = item.id
+                data["items-%s-quantity" % i] = 2
+            with CaptureQueriesContext(connection) as queries:
+                formset = CartItemFormSet(data, instance=cart)
+                self.assertTrue(formset.is_valid())
+            return len(queries)
+
+        self.assertEqual(num_queries(1), num_queries(10))
+
+    def test_remove_stock(self):
+        """
+        Test stock is only removed when all SKUs have enough in stock,
+        and the SKUs without enough are returned otherwise.
+        """
+        self._reset_variations()
+        first, second = self._product.variations.all()[:2]
+        ProductVariation.objects.filter(id=second.id).update(num_in_stock=1)
+        quantities = {first.sku: 2, second.sku: 2}
+        remove_stock = ProductVariation.objects.remove_stock
+        self.assertEqual(remove_stock(quantities), [second.sku])
+        num_in_stock = lambda v: ProductVariation.objects.get(
+            id=v.id).num_in_stock
+        self.assertEqual(num_in_stock(first), TEST_STOCK * 2)
+        quantities[second.sku] = 1
+        self.assertEqual(remove_stock(quantities), [])
+        self.assertEqual(num_in_stock(first), TEST_STOCK * 2 - 2)
+        self.assertEqual(num_in_stock(second), 0)
+
+    def test_cart_purchase(self):
+        """
+        Test purchasing a cart removes its items from stock and
+        records each product as purchased, and that the number of
+        queries doesn't grow with the number of items in the cart.
+        """
+        self._product.variations.all().delete()
+        self._product.variations.create_from_options(self._options)
+        self._product.variations.update(unit_price=TEST_PRICE,
+                                        num_in_stock=TEST_STOCK)
+        variations = list(self._product.variations.all())
+
+        def num_queries(num_items):
+            cart = Cart.objects.create(last_updated=now())
+            for variation in variations[:num_items]:
+                cart.add_item(variation, 1)
+            cart = Cart.objects.get(id=cart.id)
+            with CaptureQueriesContext(connection) as queries:
+                cart.purchase()
+            return len(queries)
+
+        self.assertEqual(num_queries(2), num_queries(10))
+        in_stock = self._product.variations.get(sku=variations[0].sku)
+        self.assertEqual(in_stock.num_in_stock, TEST_STOCK - 2)
+        action = self._product.actions.get()
+        self.assertEqual(action.total_purchase, 12)
+        # Stock not removed before payment is removed even if it's no
+        # longer available, and the SKUs are returned.
+        cart = Cart.objects.create(last_updated=now())
+        cart.add_item(variations[0], TEST_STOCK)
+        self.assertEqual(cart.purchase(), [variations[0].sku])
+        in_stock = self._product.variations.get(sku=variations[0].sku)
+        self.assertEqual(in_stock.num_in_stock, -2)
+
+    def test_buffered_product_actions(self):
+        """
+        Test buffered product action counters are only written to the
+        database when the buffer is flushed.
+        """
+        with override_settings(SHOP_PRODUCT_ACTION_BUFFER="memory"):
+            for i in range(3):
+                self._product.actions.added_to_cart()
+            self.assertFalse(self._product.actions.exists())
+            # A timer flushes the buffer if the process goes idle.
+            self.assertTrue(actions._state["timer"].is_alive())
+            call_command("flush_product_actions")
+            self.assertEqual(actions._state["timer"], None)
+        action = self._product.actions.get()
+        self.assertEqual(action.total_cart, 3)
+
+    def test_cached_product_actions(self):
+        """
+        Test product action counters buffered in the cache are only
+        skipped by a flush once their slot has been missing for longer
+        than the slot timeout.
+        """
+        cache.clear()
+        today = date.today().toordinal()
+        total_cart = lambda: self._product.actions.get().total_cart
+        with override_settings(SHOP_PRODUCT_ACTION_BUFFER="cache"):
+            self._product.actions.added_to_cart()
+            self.assertEqual(total_cart(), 1)
+            # Allocate a slot without setting it, as a concurrent
+            # process would between allocating and setting it.
+            slot = cache.incr(actions.CACHE_COUNT_KEY)
+            self._product.actions.added_to_cart()
+            call_command("flush_product_actions")
+            self.assertEqual(total_cart(), 1)
+            cache.set(actions.CACHE_SLOT_KEY % slot,
+                      ("total_cart", today, {self._product.id: 1}), None)
+            call_command("flush_product_actions")
+            self.assertEqual(total_cart(), 3)
+            # Slots missing past the timeout are skipped as evicted.
+            slot = cache.incr(actions.CACHE_COUNT_KEY)
+            self._product.actions.added_to_cart()
+            cache.set(actions.CACHE_GAP_KEY, (slot, 0), None)
+            call_command("flush_product_actions")
+            self.assertEqual(total_cart(), 4)
+
+    def test_popularity(self):
+        """
+        Test product popularity is kept up to date as actions are
+        recorded, matches a full rebuild, and favours recent actions.
+        """
+        today = date.today().toordinal()
+        ProductAction.objects.increment("total_cart", {self._product.id: 2})
+        ProductAction.objects.increment("total_purchase",
+                                        {self._product.id: 1}, today - 30)
+        popularity = Product.objects.get(id=self._product.id).popularity
+        self.assertTrue(popularity > 0)
+        Product.objects.update(popularity=0)
+        call_command("rebuild_popularity")
+        rebuilt = Product.objects.get(id=self._product.id).popularity
+        self.assertAlmostEqual(popularity / rebuilt, 1)
+        self.assertTrue(popularity_score("total_cart", 1, today) >
+                        popularity_score("total_cart", 1, today - 1))
+        # Scores don't overflow however short the half life.
+        with override_settings(SHOP_POPULARITY_HALF_LIFE=1):
+            ProductAction.objects.increment("total_cart",
+                                            {self._product.id: 1})
+            call_command("rebuild_popularity")
+        product = Product.objects.get(id=self._product.id)
+        self.assertTrue(product.popularity > rebuilt)
+
     def test_discount_codes(self):
         """
         Test that all types of discount codes are applied.
@@ -314,6 +807,92 @@ class ShopTests(TestCase):
                     self.assertFormError(r, "discount_form", "discount_code",
                                   _("The discount code entered is invalid."))
 
+    def test_discount_recalculation(self):
+        """
+        Test a discount code's total is recalculated when the cart's
+        quantities change without the code being validated again,
+        and that it's validated again when a new SKU is added.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        discount = DiscountCode.objects.create(code="item", active=True,
+                                               discount_percent=10)
+        discount.products.add(variation.product)
+        self._add_to_cart(variation, 1)
+        self.client.post(reverse("shop_cart"), {"discount_code": "item"})
+        discount_table = DiscountCode._meta.db_table
+        with CaptureQueriesContext(connection) as context:
+            self._add_to_cart(variation, 1)
+        queries = " ".join([q["sql"] for q in context.captured_queries])
+        self.assertFalse(discount_table in queries)
+        self.assertEqual(Decimal(self.client.session["discount_total"]),
+                         TEST_PRICE / 10 * 2)
+        other = Product.objects.create(**self._published)
+        other.variations.create(sku="other", unit_price=TEST_PRICE)
+        with CaptureQueriesContext(connection) as context:
+            self._add_to_cart(other.variations.get(), 1)
+        queries = " ".join([q["sql"] for q in context.captured_queries])
+        self.assertTrue(discount_table in queries)
+        self.assertEqual(Decimal(self.client.session["discount_total"]),
+                         TEST_PRICE / 10 * 2)
+
+    def test_discount_reservation(self):
+        """
+        Test a discount code's last use is reserved for the cart it's
+        applied to, isn't available to other carts, and is returned to
+        the code when the cart is deleted.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        DiscountCode.objects.create(code="once", active=True,
+                                    discount_deduct=1, uses_remaining=1)
+        uses_remaining = lambda: DiscountCode.objects.get().uses_remaining
+        self._add_to_cart(variation, 1)
+        self.client.post(reverse("shop_cart"), {"discount_code": "once"})
+        self.assertEqual(uses_remaining(), 0)
+        self._add_to_cart(variation, 1)
+        self.assertEqual(self.client.session["discount_code"], "once")
+        cart = Cart.objects.get()
+        other = Cart.objects.create()
+        self.assertRaises(DiscountCode.DoesNotExist,
+                          DiscountCode.objects.get_valid, "once", other)
+        self.assertEqual(DiscountCode.objects.get_valid("once", cart).code,
+                         "once")
+        Cart.objects.filter(id=cart.id).delete()
+        self.assertEqual(uses_remaining(), 1)
+        # Completing the order via a PayPal IPN commits the use.
+        self._add_to_cart(variation, 1)
+        self.client.post(reverse("shop_cart"), {"discount_code": "once"})
+        cart = Cart.objects.get(id=self.client.session["cart"])
+        Order.objects.create(transaction_id="ipn")
+        custom = "%s,%s" % (self.client.session.session_key, cart.id)
+        ipn = type(str("IPN"), (object,), {"custom": custom,
+                                            "invoice": "ipn"})
+        self._quietly(payment_complete, ipn)
+        self.assertFalse(Cart.objects.filter(id=cart.id).exists())
+        self.assertEqual(uses_remaining(), 0)
+        # Redeeming without a reservation fails with no uses remaining.
+        self.assertFalse(DiscountReservation.objects.redeem("once", Cart()))
+        self.assertEqual(uses_remaining(), 0)
+
+    def test_discount_skus(self):
+        """
+        Test the SKUs a discount applies to are cached, and invalidated
+        when its products change.
+        """
+        self._reset_variations()
+        variations = self._product.variations.all()
+        discount = DiscountCode.objects.create(code="item", active=True)
+        with override_settings(SHOP_DISCOUNT_CACHE_SECONDS=60):
+            self.assertEqual(discount.applicable_skus(), None)
+            discount.products.add(self._product)
+            skus = set(variations.values_list("sku", flat=True))
+            self.assertEqual(discount.applicable_skus(), skus)
+            with self.assertNumQueries(0):
+                self.assertEqual(discount.applicable_skus(), skus)
+            self._product.variations.create(sku="new")
+            self.assertEqual(discount.applicable_skus(), skus | set(["new"]))
+
     def test_order(self):
         """
         Test that a completed order contains cart items and that
@@ -335,6 +914,14 @@ class ShopTests(TestCase):
         for field_name, field in list(OrderForm(None, None).fields.items()):
             value = field.choices[-1][1] if hasattr(field, "choices") else "1"
             data.setdefault(field_name, value)
+        # Stock removed before payment is returned if payment fails
+        # with an unexpected error.
+        path = "cartridge.shop.tests.failing_payment_handler"
+        with override_settings(SHOP_HANDLER_PAYMENT=path):
+            self.assertRaises(KeyError, self.client.post,
+                              reverse("shop_checkout"), data)
+        self.assertEqual(self._product.variations.all()[0].num_in_stock,
+                         TEST_STOCK * 2)
         self.client.post(reverse("shop_checkout"), data)
         try:
             order = Order.objects.from_request(self.client)
@@ -350,6 +937,155 @@ class ShopTests(TestCase):
         self.assertEqual(variation.num_in_stock, TEST_STOCK)
         self.assertEqual(order.item_total, TEST_PRICE * TEST_STOCK)
 
+    def _import_products(self, rows, **kwargs):
+        """
+        Writes the given title, SKU, option and price rows to a csv
+        file and imports it.
+        """
+        from cartridge.shop.management.commands import product_db
+        option = list(product_db.TYPE_CHOICES)[0]
+        csv_file = NamedTemporaryFile(mode="w", suffix=".csv")
+        writer = csv.DictWriter(csv_file, fieldnames=product_db.fieldnames,
+                                restval="")
+        writer.writeheader()
+        for title, sku, name, price in rows:
+            writer.writerow({product_db.TITLE: title, product_db.SKU: sku,
+                             product_db.CATEGORY: "Imported",
+                             product_db.SUB_CATEGORY: "Sub",
+                             product_db.NUM_IN_STOCK: TEST_STOCK,
+                             product_db.UNIT_PRICE: price, option: name})
+        csv_file.flush()
+        self._quietly(product_db.import_products, csv_file.name,
+                      batch_size=2, **kwargs)
+
+    def _quietly(self, func, *args, **kwargs):
+        """
+        Calls the function without the output it prints.
+        """
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            func(*args, **kwargs)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def test_product_import(self):
+        """
+        Test the bulk product importer creates products, variations,
+        options and categories across batches, and syncs each
+        product's fields with its default variation.
+        """
+        self._import_products([("Import %s" % (i // 2), "Import-%s" % i,
+                                "Red %s" % i, Decimal(i + 1))
+                               for i in range(5)])
+        products = Product.objects.filter(title__startswith="Import ")
+        self.assertEqual(products.count(), 3)
+        self.assertEqual(ProductVariation.objects.filter(
+            sku__startswith="Import-").count(), 5)
+        self.assertEqual(ProductOption.objects.filter(
+            name__startswith="Red ").count(), 5)
+        for product in products:
+            default = product.variations.get(default=True)
+            self.assertEqual(product.unit_price, default.unit_price)
+            self.assertEqual(product.sku, default.sku)
+            self.assertEqual(product.categories.count(), 2)
+        self.assertEqual(Category.objects.filter(title="Sub",
+                                                 parent__title="Imported")
+                         .count(), 1)
+
+    def test_product_upsert(self):
+        """
+        Test that upserting updates variations by SKU, skips unchanged
+        rows without writing anything, and unpublishes products
+        missing from the feed.
+        """
+        rows = [("Import %s" % (i // 2), "Import-%s" % i, "Red %s" % i,
+                 Decimal(i + 1)) for i in range(4)]
+        self._import_products(rows)
+        with CaptureQueriesContext(connection) as context:
+            self._import_products(rows, upsert=True)
+        self.assertFalse([q for q in context.captured_queries
+                          if q["sql"].startswith(("INSERT", "UPDATE",
+                                                  "DELETE"))])
+        rows[0] = rows[0][:3] + (TEST_PRICE,)
+        rows.append(("Import 2", "Import-4", "Red 4", TEST_PRICE))
+        self._import_products(rows, upsert=True, unpublish_missing=True)
+        variation = ProductVariation.objects.get(sku="Import-0")
+        self.assertEqual(variation.unit_price, TEST_PRICE)
+        self.assertEqual(variation.product.unit_price, TEST_PRICE)
+        self.assertTrue(ProductVariation.objects.filter(
+            sku="Import-4").exists())
+        published = Product.objects.filter(status=CONTENT_STATUS_PUBLISHED)
+        self.assertEqual(set(published.values_list("title", flat=True)),
+                         set(["Import 0", "Import 1", "Import 2"]))
+        # Products unpublished when missing are published again when
+        # their unchanged rows return to the feed.
+        self._import_products(rows[:2], upsert=True, unpublish_missing=True)
+        self.assertFalse(published.filter(title="Import 1").exists())
+        self._import_products(rows, upsert=True)
+        self.assertEqual(set(published.values_list("title", flat=True)),
+                         set(["Import 0", "Import 1", "Import 2"]))
+
+    def test_stock_feed(self):
+        """
+        Test the stock feed command updates only the columns in the
+        feed for variations by SKU, along with the denormalised fields
+        of the products of default variations.
+        """
+        from cartridge.shop.management.commands import product_db
+        self._import_products([("Import", "Import-%s" % i, "Red %s" % i,
+                                TEST_PRICE) for i in range(2)])
+        csv_file = NamedTemporaryFile(mode="w", suffix=".csv")
+        writer = csv.writer(csv_file)
+        writer.writerow([product_db.SKU, product_db.NUM_IN_STOCK,
+                         product_db.SALE_PRICE])
+        writer.writerow(["Import-0", 1, "10"])
+        writer.writerow(["Import-1", 2, ""])
+        writer.writerow(["Missing", 3, ""])
+        csv_file.flush()
+        call_command("stock_feed", csv_file.name, verbosity=0)
+        first = ProductVariation.objects.get(sku="Import-0")
+        second = ProductVariation.objects.get(sku="Import-1")
+        self.assertEqual((first.num_in_stock, first.sale_price,
+                          first.unit_price), (1, Decimal("10"), TEST_PRICE))
+        self.assertEqual((second.num_in_stock, second.sale_price), (2, None))
+        product = first.product
+        self.assertTrue(first.default)
+        self.assertEqual((product.num_in_stock, product.sale_price,
+                          product.unit_price), (1, Decimal("10"), TEST_PRICE))
+
+    def test_product_export(self):
+        """
+        Test the exporter's queries don't grow with the number of
+        variations, and that its csv and gzipped NDJSON output both
+        contain every variation.
+        """
+        from cartridge.shop.management.commands import product_db
+        self._import_products([("Import %s" % (i // 2), "Import-%s" % i,
+                                "Red %s" % i, Decimal(i + 1))
+                               for i in range(5)])
+        skus = set(ProductVariation.objects.values_list("sku", flat=True))
+        ndjson_file = NamedTemporaryFile(suffix=".ndjson.gz")
+        with CaptureQueriesContext(connection) as context:
+            self._quietly(product_db.export_products, ndjson_file.name,
+                          "ndjson", len(skus))
+        # Mezzanine looks up the current site for each related manager
+        # while a request is active, which doesn't occur in the command.
+        self.assertEqual(len([q for q in context.captured_queries
+                              if "django_site" not in q["sql"]]), 3)
+        rows = [json.loads(line.decode("utf-8"))
+                for line in gzip.open(ndjson_file.name)]
+        self.assertEqual(set([r[product_db.SKU] for r in rows]), skus)
+        row = [r for r in rows if r[product_db.SKU] == "Import-0"][0]
+        self.assertEqual((row[product_db.CATEGORY],
+                          row[product_db.SUB_CATEGORY]), ("Imported", "Sub"))
+        csv_file = NamedTemporaryFile(suffix=".csv")
+        self._quietly(product_db.export_products, csv_file.name,
+                      chunk_size=2)
+        rows = list(product_db._read_rows(csv_file.name))
+        self.assertEqual(set([r[product_db.SKU] for r in rows]), skus)
+
     def test_syntax(self):
         """
         Run pyflakes/pep8 across the code base to check for potential errors.
@@ -523,6 +1259,26 @@ class TaxationTests(TestCase):
         handler = lambda s: import_dotted_path(s) if s else lambda *args: None
         self.assertTrue(handler(settings.SHOP_HANDLER_TAX) is not None)
 
+    def test_checkout_handler(self):
+        """
+        Test checkout handlers follow changes to their settings, and
+        have the time taken by each call recorded.
+        """
+        calls = checkout.handler_timings.get("SHOP_HANDLER_TAX",
+                                             {"calls": 0})["calls"]
+
+        class request:
+            session = {}
+
+        path = "cartridge.shop.tests.custom_tax_handler"
+        with override_settings(SHOP_HANDLER_TAX=path):
+            checkout.tax_handler(request, None)
+        self.assertEqual(request.session["tax_type"], "Custom")
+        checkout.tax_handler(request, None)
+        self.assertEqual(request.session["tax_type"], "Tax")
+        timing = checkout.handler_timings["SHOP_HANDLER_TAX"]
+        self.assertEqual(timing["calls"], calls + 2)
+
     def test_set_tax(self):
         """
         Regression test to ensure that set_tax still sets the appropriate
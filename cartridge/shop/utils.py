@@ -2,6 +2,8 @@ from __future__ import absolute_import, unicode_literals
 from future.builtins import bytes, zip, str as _str
 
 import hmac
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
 from locale import setlocale, LC_MONETARY, Error as LocaleError
 
 try:
@@ -9,11 +11,19 @@ try:
 except ImportError:
     from md5 import new as digest
 
+from django.core import signing
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Case, F, IntegerField, Q, Value, When
 from django.utils.translation import ugettext as _
 
 from mezzanine.conf import settings
-from mezzanine.utils.importing import import_dotted_path
+
+
+KEYSET_SALT = "cartridge.shop.utils.keyset_paginate"
+
+# Session variables used to price the cart, along with its items.
+PRICING_SESSION_FIELDS = ("shipping_type", "shipping_total",
+                          "discount_total", "tax_type", "tax_total")
 
 
 def make_choices(choices):
@@ -41,16 +51,33 @@ def recalculate_cart(request):
     cart is modified.
     """
     from cartridge.shop import checkout
-    from cartridge.shop.forms import DiscountForm
-    from cartridge.shop.models import Cart
+    from cartridge.shop.carts import cart_from_request
+    from cartridge.shop.forms import DiscountForm, cached_discount_total
+    from cartridge.shop.models import DiscountReservation
 
     # Rebind the cart to request since it's been modified.
     if request.session.get('cart') != request.cart.pk:
         request.session['cart'] = request.cart.pk
-    request.cart = Cart.objects.from_request(request)
+    request.session.pop("cart_summary", None)
+    request.cart = cart_from_request(request)
+
+    # Store a summary of the cart's items in the session, assigned to
+    # the cart on subsequent requests by ``cart_from_request``.
+    if request.cart.pk:
+        summary = request.cart.summarize()
+        request.session["cart_summary"] = dict(summary, cart=request.cart.pk,
+                                               total=_str(summary["total"]))
+        request.cart.summary = summary
 
+    # Recalculate the discount total without validating the discount
+    # code again, if what it applies to still covers the cart.
     discount_code = request.session.get("discount_code", "")
+    discount_total = None
     if discount_code:
+        discount_total = cached_discount_total(request)
+    if discount_total is not None:
+        request.session["discount_total"] = _str(discount_total)
+    elif discount_code:
         # Clear out any previously defined discount code
         # session vars.
         names = ("free_shipping", "discount_code", "discount_total")
@@ -58,14 +85,16 @@ def recalculate_cart(request):
         discount_form = DiscountForm(request, {"discount_code": discount_code})
         if discount_form.is_valid():
             discount_form.set_discount()
+        elif request.cart.pk:
+            reservations = DiscountReservation.objects
+            reservations.filter(cart_id=request.cart.pk).release()
 
-    handler = lambda s: import_dotted_path(s) if s else lambda *args: None
-    billship_handler = handler(settings.SHOP_HANDLER_BILLING_SHIPPING)
-    tax_handler = handler(settings.SHOP_HANDLER_TAX)
     try:
         if request.session["order"]["step"] >= checkout.CHECKOUT_STEP_FIRST:
-            billship_handler(request, None)
-            tax_handler(request, None)
+            checkout.call_handler_if_changed(checkout.billship_handler,
+                                             request, None)
+            checkout.call_handler_if_changed(checkout.tax_handler,
+                                             request, None)
     except (checkout.CheckoutError, ValueError, KeyError):
         pass
 
@@ -86,6 +115,67 @@ def set_tax(request, tax_type, tax_total):
     request.session["tax_total"] = _str(tax_total)
 
 
+def cart_totals(request):
+    """
+    Returns a dict of the item, shipping, discount, tax and order
+    totals for the request's cart, along with the shipping and tax
+    types. The totals are computed once and cached on the cart, keyed
+    by the cart's version and the pricing variables in the session,
+    so that checkout, order creation and each call to the
+    ``order_totals`` template tags all use the same totals.
+    """
+    cart = request.cart
+    item_total = cart.total_price()
+    inputs = tuple([request.session.get(name)
+                    for name in PRICING_SESSION_FIELDS])
+    version = (cart.pk, item_total, inputs)
+    cached = getattr(cart, "_totals", None)
+    if cached is not None and cached[0] == version:
+        return dict(cached[1])
+    totals = dict(zip(PRICING_SESSION_FIELDS, inputs))
+    totals["item_total"] = item_total
+    if not item_total:
+        # Ignore session if cart has no items, as cart may have
+        # expired sooner than the session.
+        totals.update(shipping_total=0, discount_total=0, tax_total=0)
+    order_total = Decimal(item_total)
+    for name, direction in (("shipping_total", 1), ("discount_total", -1),
+                            ("tax_total", 1)):
+        if totals[name] is not None:
+            totals[name] = Decimal(_str(totals[name]))
+            order_total += totals[name] * direction
+    totals["order_total"] = order_total.quantize(Decimal("0.01"),
+                                                 ROUND_HALF_UP)
+    cart._totals = (version, totals)
+    return dict(totals)
+
+
+def case_update(queryset, values, key="id"):
+    """
+    Given a dict mapping values of the ``key`` field to dicts of field
+    values, updates the matching rows of the queryset with a single
+    query for each field, using a ``CASE`` expression with a branch
+    for each distinct value, since Django has no ``bulk_update``.
+    Returns the number of rows matched.
+    """
+    model = queryset.model
+    queryset = queryset.filter(**{"%s__in" % key: list(values)})
+    names = set([name for fields in values.values() for name in fields])
+    matched = 0
+    for name in names:
+        field = model._meta.get_field(name)
+        keys_by_value = defaultdict(list)
+        for value_key, fields in values.items():
+            if name in fields:
+                keys_by_value[fields[name]].append(value_key)
+        whens = [When(then=Value(value, output_field=field),
+                      **{"%s__in" % key: keys})
+                 for value, keys in keys_by_value.items()]
+        value = Case(*whens, default=F(field.attname), output_field=field)
+        matched = queryset.update(**{name: value})
+    return matched
+
+
 def sign(value):
     """
     Returns the hash of the given value, used for signing order key stored in
@@ -96,6 +186,91 @@ def sign(value):
     return hmac.new(key, value, digest).hexdigest()
 
 
+class KeysetPage(object):
+    """
+    A page of objects returned by ``keyset_paginate``, which has an
+    opaque cursor for the next page rather than page numbers, since
+    the total number of objects isn't counted.
+    """
+
+    keyset = True
+
+    def __init__(self, object_list, next_cursor, has_previous,
+                 querystring=""):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.has_previous = has_previous
+        self.querystring = querystring
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def keyset_paginate(objects, order_by, cursor, per_page, query=None):
+    """
+    Returns a ``KeysetPage`` for the given queryset, ordered by the
+    given field name (optionally prefixed with ``-`` for descending
+    order) and then primary key, starting after the position encoded
+    in the given cursor. Rather than an OFFSET, each page filters on
+    the sort values of the last object on the previous page, so deep
+    pages are as fast as the first. NULL values sort last in either
+    direction. If given, ``query`` is a QueryDict of the request's
+    querystring, which is stored on the page without the cursor for
+    building links.
+    """
+    descending = order_by.startswith("-")
+    name = order_by.lstrip("-")
+    field = objects.model._meta.get_field(name)
+    after = "%s__lt" if descending else "%s__gt"
+    is_null = {"%s__isnull" % name: True}
+    objects = objects.annotate(keyset_null=Case(When(then=Value(1),
+        **is_null), default=Value(0), output_field=IntegerField()))
+    objects = objects.order_by("keyset_null", order_by,
+                               "-pk" if descending else "pk")
+    position = None
+    if cursor:
+        try:
+            position = signing.loads(cursor, salt=KEYSET_SALT)
+            value_is_null, value, pk = position
+        except (signing.BadSignature, TypeError, ValueError):
+            position = None
+    if position:
+        same_value = Q(**{after % "pk": pk})
+        if value_is_null:
+            objects = objects.filter(Q(**is_null) & same_value)
+        else:
+            value = field.to_python(value)
+            same_value &= Q(**{name: value})
+            objects = objects.filter(Q(**{after % name: value}) |
+                                     same_value | Q(**is_null))
+    object_list = list(objects[:per_page + 1])
+    next_cursor = None
+    if len(object_list) > per_page:
+        object_list = object_list[:per_page]
+        last = object_list[-1]
+        value = getattr(last, name)
+        if isinstance(value, float):
+            # Avoid the precision lost converting floats to strings.
+            value = repr(value)
+        elif value is not None:
+            value = field.value_to_string(last)
+        next_position = [value is None, value, last.pk]
+        next_cursor = signing.dumps(next_position, salt=KEYSET_SALT)
+    querystring = ""
+    if query is not None:
+        query = query.copy()
+        query.pop("cursor", None)
+        querystring = query.urlencode()
+    return KeysetPage(object_list, next_cursor, bool(position), querystring)
+
+
 def set_locale():
     """
     Sets the locale for currency formatting.
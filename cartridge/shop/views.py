@@ -2,12 +2,15 @@ from __future__ import unicode_literals
 
 from json import dumps
 
-from cartridge.shop import checkout
+from cartridge.shop import caching, checkout
+from cartridge.shop.carts import StoredCart, persist_cart
 from cartridge.shop.forms import (AddProductForm, CartItemFormSet,
-                                  DiscountForm, OrderForm)
-from cartridge.shop.models import DiscountCode
+                                  DiscountForm, OrderForm,
+                                  StoredCartItemFormSet)
+from cartridge.shop.models import DiscountCode, DiscountReservation
 from cartridge.shop.models import Product, ProductVariation, Order
-from cartridge.shop.utils import recalculate_cart, sign
+from cartridge.shop.utils import (clear_session, keyset_paginate,
+                                  recalculate_cart, sign)
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login as auth_login
 from django.contrib.auth.models import User
@@ -45,11 +48,37 @@ HAS_PDF = pisa is not None
 
 
 # Set up checkout handlers.
-handler = lambda s: import_dotted_path(s) if s else lambda *args: None
-billship_handler = handler(settings.SHOP_HANDLER_BILLING_SHIPPING)
-tax_handler = handler(settings.SHOP_HANDLER_TAX)
-payment_handler = handler(settings.SHOP_HANDLER_PAYMENT)
-order_handler = handler(settings.SHOP_HANDLER_ORDER)
+billship_handler = checkout.billship_handler
+tax_handler = checkout.tax_handler
+payment_handler = checkout.payment_handler
+order_handler = checkout.order_handler
+
+
+def _product_context(product):
+    """
+    Builds the parts of the product page's context that only depend
+    on the product, for caching with ``caching.product_context``.
+    """
+    fields = [f.name for f in ProductVariation.option_fields()]
+    variations = list(product.variations.all())
+    variations_json = dumps([dict([(f, getattr(v, f))
+        for f in fields + ["sku", "image_id"]]) for v in variations])
+    option_values = list(zip(*[[getattr(v, f) for f in fields]
+                               for v in variations
+                               if v.unit_price is not None]))
+    related_ids = []
+    if settings.SHOP_USE_RELATED_PRODUCTS:
+        related_ids = list(product.related_products.values_list("id",
+                                                                flat=True))
+    return {
+        "variations": variations,
+        "variations_json": variations_json,
+        "option_values": option_values,
+        "images": list(product.images.all()),
+        "related_ids": related_ids,
+        "category_keywords": [category.keywords_string for category in
+                              product.categories.all()],
+    }
 
 
 def product(request, slug, template="shop/product.html",
@@ -61,9 +90,11 @@ def product(request, slug, template="shop/product.html",
     published_products = Product.objects.published(for_user=request.user)
     product = get_object_or_404(published_products, slug=slug)
     fields = [f.name for f in ProductVariation.option_fields()]
-    variations = product.variations.all()
-    variations_json = dumps([dict([(f, getattr(v, f))
-        for f in fields + ["sku", "image_id"]]) for v in variations])
+    if request.user.is_staff:
+        cached = _product_context(product)
+    else:
+        cached = caching.product_context(product, _product_context)
+    variations = cached["variations"]
     to_cart = (request.method == "POST" and
                request.POST.get("add_wishlist") is None)
     initial_data = {}
@@ -71,7 +102,9 @@ def product(request, slug, template="shop/product.html",
         initial_data = dict([(f, getattr(variations[0], f)) for f in fields])
     initial_data["quantity"] = 1
     add_product_form = form_class(request.POST or None, product=product,
-                                  initial=initial_data, to_cart=to_cart)
+        initial=initial_data, to_cart=to_cart,
+        category_keywords=cached["category_keywords"],
+        option_values=cached["option_values"])
     if request.method == "POST":
         if add_product_form.is_valid():
             if to_cart:
@@ -90,14 +123,16 @@ def product(request, slug, template="shop/product.html",
                 set_cookie(response, "wishlist", ",".join(skus))
                 return response
     related = []
-    if settings.SHOP_USE_RELATED_PRODUCTS:
-        related = product.related_products.published(for_user=request.user)
+    if settings.SHOP_USE_RELATED_PRODUCTS and cached["related_ids"]:
+        related = list(Product.objects.published(for_user=request.user
+                       ).filter(id__in=cached["related_ids"]))
+        Product.objects.prefetch_required_permissions(related)
     context = {
         "product": product,
         "editable_obj": product,
-        "images": product.images.all(),
+        "images": cached["images"],
         "variations": variations,
-        "variations_json": variations_json,
+        "variations_json": cached["variations_json"],
         "has_available_variations": any([v.has_price() for v in variations]),
         "related_products": related,
         "add_product_form": add_product_form
@@ -149,6 +184,8 @@ def wishlist(request, template="shop/wishlist.html",
     f = {"product__in": published_products, "sku__in": skus}
     wishlist = ProductVariation.objects.filter(**f).select_related("product")
     wishlist = sorted(wishlist, key=lambda v: skus.index(v.sku))
+    Product.objects.prefetch_required_permissions([variation.product
+                                                   for variation in wishlist])
     context = {"wishlist_items": wishlist, "error": error}
     context.update(extra_context or {})
     response = TemplateResponse(request, template, context)
@@ -161,11 +198,14 @@ def wishlist(request, template="shop/wishlist.html",
 @never_cache
 def cart(request, template="shop/cart.html",
          cart_formset_class=CartItemFormSet,
+         stored_cart_formset_class=StoredCartItemFormSet,
          discount_form_class=DiscountForm,
          extra_context=None):
     """
     Display cart and handle removing items from the cart.
     """
+    if isinstance(request.cart, StoredCart):
+        cart_formset_class = stored_cart_formset_class
     cart_formset = cart_formset_class(instance=request.cart)
     discount_form = discount_form_class(request, request.POST or None)
     if request.method == "POST":
@@ -196,6 +236,7 @@ def cart(request, template="shop/cart.html",
             valid = discount_form.is_valid()
             if valid:
                 discount_form.set_discount()
+                valid = not discount_form.errors
             # Potentially need to set shipping if a discount code
             # was previously entered with free shipping, and then
             # another was entered (replacing the old) without
@@ -239,6 +280,7 @@ def checkout_steps(request, form_class=OrderForm, extra_context=None):
              "passing in your own form_class argument.")
         form_class = import_dotted_path(settings.SHOP_CHECKOUT_FORM_CLASS)
 
+    persist_cart(request)
     initial = checkout.initial_order_data(request, form_class)
     _shipping= request.cart.need_to_ship()
     step = int(request.POST.get("step", None) or
@@ -297,15 +339,43 @@ def checkout_steps(request, form_class=OrderForm, extra_context=None):
                 # and send the order receipt email.
                 order = form.save(commit=False)
                 order.setup(request)
-                # Try payment.
+                # Reserve a use of the discount code, if it has limited
+                # uses, before payment. The reservation is released if
+                # payment fails, and committed when the order is
+                # complete.
+                discount_code = request.session.get("discount_code")
+                reservations = DiscountReservation.objects
                 try:
+                    if discount_code and not reservations.reserve(
+                            discount_code, request.cart):
+                        clear_session(request, "discount_code",
+                                      "discount_total", "free_shipping")
+                        raise checkout.CheckoutError(
+                            _("The discount code entered is no longer "
+                              "available."))
+                    # Remove the items from stock before payment, which
+                    # fails if any of them are no longer in stock.
+                    if request.cart.remove_stock():
+                        raise checkout.CheckoutError(
+                            _("Some items in your cart are no longer in "
+                              "stock, please update your cart."))
+                    # Try payment.
                     transaction_id = payment_handler(request, form, order)
                 except checkout.CheckoutError as e:
                     # Error in payment handler.
                     order.delete()
+                    request.cart.restore_stock()
+                    reservations.filter(cart_id=request.cart.pk).release()
                     checkout_errors.append(e)
                     if settings.SHOP_CHECKOUT_STEPS_CONFIRMATION:
                         step -= 1
+                except Exception:
+                    # Unexpected error, such as a gateway timeout, so
+                    # payment wasn't taken. Return the stock and the
+                    # discount code use held for the order.
+                    request.cart.restore_stock()
+                    reservations.filter(cart_id=request.cart.pk).release()
+                    raise
                 else:
                     # Finalize order - ``order.complete()`` performs
                     # final cleanup of session and cart.
@@ -381,6 +451,7 @@ def express_steps(request, form_class=OrderForm, extra_context=None):
     #maybe need to modify this to not pull regular orders from db or session
     #perhaps we should get rid of this because well give paypal shipping details priority
     #and let them be changed on a per instance basis
+    persist_cart(request)
     initial = checkout.initial_order_data(request, form_class,express=True)
     #this only posts during final step therefore will never get a post step variable
     step = int(request.POST.get("step", None) or
@@ -505,17 +576,30 @@ def express_steps(request, form_class=OrderForm, extra_context=None):
                 if request.method == 'POST' or not _shipping:
                     print 'step 3 and post or _noshipping'
                     
+                    order.setup(request)
+                    # Remove the items from stock before payment, which
+                    # fails if any of them are no longer in stock.
+                    if request.cart.remove_stock():
+                        order.delete()
+                        error(request, _("Some items in your cart are no "
+                                         "longer in stock, please update "
+                                         "your cart."))
+                        return redirect('shop_express_checkout_cancel')
                     try:
-                        order.setup(request)
                         nvp_obj = wpp.doExpressCheckoutPayment({'token':token,'payerid':payerid,\
                                 'paymentrequest_0_amt':order.total})
                           
                     except PayPalFailure as e:
                         
                         order.delete()
+                        request.cart.restore_stock()
                         checkout_errors.append(e)
                         error(request,e)
                         return redirect('shop_express_checkout_cancel')
+                    except Exception:
+                        # Payment wasn't taken, so return the stock.
+                        request.cart.restore_stock()
+                        raise
                     else:
                         order.complete(request,express=True)
                         order_handler(request, form, order)
@@ -615,10 +699,16 @@ def order_history(request, template="shop/order_history.html",
     all_orders = (Order.objects
                   .filter(user_id=request.user.id)
                   .annotate(quantity_total=Sum('items__quantity')))
-    orders = paginate(all_orders.order_by('-time'),
-                      request.GET.get("page", 1),
-                      settings.SHOP_PER_PAGE_CATEGORY,
-                      settings.MAX_PAGING_LINKS)
+    if settings.SHOP_KEYSET_PAGINATION:
+        orders = keyset_paginate(all_orders, "-time",
+                                 request.GET.get("cursor"),
+                                 settings.SHOP_PER_PAGE_CATEGORY,
+                                 request.GET)
+    else:
+        orders = paginate(all_orders.order_by('-time'),
+                          request.GET.get("page", 1),
+                          settings.SHOP_PER_PAGE_CATEGORY,
+                          settings.MAX_PAGING_LINKS)
     context = {"orders": orders, "has_pdf": HAS_PDF}
     context.update(extra_context or {})
     return TemplateResponse(request, template, context)